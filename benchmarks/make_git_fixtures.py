@@ -0,0 +1,80 @@
+import argparse
+import os
+import random
+import subprocess
+
+# Creates bare git repositories to compare LOC_ENGINE=git with the GraphQL engine on the same histories
+# Each repository gets commits by the benchmarked user and by others, merges of side branches, deleted lines and a binary file.
+# Serve them with mock_github.py --git-fixtures DIR, and point LOC_ENGINE=git at them with GIT_REMOTE_URL=file://DIR/{name}.git
+# Usage: python benchmarks/make_git_fixtures.py /tmp/fixtures --repos 20
+MY_EMAIL = 'bench@example.com'
+AUTHORS = [('Bench', MY_EMAIL), ('Bench', '1234+bench@users.noreply.github.com'), ('Other', 'other@example.com'), ('Someone', 'someone@example.com')]
+
+
+def fast_import_stream(rng, commits):
+    """
+    Returns a git fast-import stream with about commits commits on main, some of them merges of short side branches
+    """
+    files = {}
+    stream = []
+    mark = 0
+    when = 1500000000
+
+    def commit(branch, parents):
+        nonlocal mark, when
+        mark += 1
+        when += rng.randint(60, 86400)
+        name, email = rng.choice(AUTHORS)
+        stream.append(f'commit refs/heads/{branch}\nmark :{mark}\n')
+        stream.append(f'author {name} <{email}> {when} +0000\ncommitter {name} <{email}> {when} +0000\n')
+        message = f'commit {mark}\n'
+        stream.append(f'data {len(message)}\n{message}')
+        for i, parent in enumerate(parents):
+            stream.append(f"{'from' if i == 0 else 'merge'} :{parent}\n")
+        for _ in range(rng.randint(1, 3)):
+            path = f'src/file{rng.randint(0, 8)}.txt'
+            lines = files.get(path, [])
+            if lines and rng.random() < 0.4: # delete some lines
+                start = rng.randrange(len(lines))
+                del lines[start:start + rng.randint(1, 10)]
+            lines = lines + [f'line {mark} {i}' for i in range(rng.randint(0, 30))]
+            files[path] = lines
+            content = ''.join(line + '\n' for line in lines)
+            stream.append(f'M 100644 inline {path}\ndata {len(content.encode())}\n{content}\n')
+        if rng.random() < 0.05:
+            content = bytes(rng.randrange(256) for _ in range(64)) + b'\0'
+            stream.append(f'M 100644 inline assets/blob{mark}.bin\ndata {len(content)}\n' + content.decode('latin-1') + '\n')
+        return mark
+
+    head = commit('main', [])
+    while mark < commits:
+        if rng.random() < 0.1: # a side branch of one or two commits, merged back
+            side = head
+            for _ in range(rng.randint(1, 2)):
+                side = commit('side', [side])
+            head = commit('main', [head, side])
+        else:
+            head = commit('main', [head])
+    return ''.join(stream).encode('latin-1')
+
+
+def make_repository(path, rng, commits):
+    subprocess.run(['git', 'init', '--quiet', '--bare', '--initial-branch=main', path], check=True)
+    subprocess.run(['git', '-C', path, 'config', 'uploadpack.allowFilter', 'true'], check=True)
+    subprocess.run(['git', '-C', path, 'fast-import', '--quiet'], input=fast_import_stream(rng, commits), check=True)
+    subprocess.run(['git', '-C', path, 'branch', '--quiet', '-D', 'side'], capture_output=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create bare git repositories for comparing the LOC engines')
+    parser.add_argument('directory')
+    parser.add_argument('--repos', type=int, default=20)
+    parser.add_argument('--commits', type=int, default=60, help='average commits per repository')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for i in range(args.repos):
+        path = os.path.join(args.directory, 'bench', f'repo{i:05d}.git')
+        make_repository(path, rng, max(1, int(rng.expovariate(1 / args.commits))))
+    print(f'Created {args.repos} repositories in {args.directory}')
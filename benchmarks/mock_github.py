@@ -0,0 +1,495 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for https://api.github.com/graphql, serving one synthetic user for the benchmarks
+# It answers the queries index.py sends (profile_getter, graph_repos_stars, loc_query, batch_loc's aliased history pages, graph_commits' yearly contributions
+# and merged_commits' commits by oid), and the REST compare merged_commits lists them with, with optional latency, 502s and a rate limit,
+# and counts requests and bytes.
+# Usage: python benchmarks/mock_github.py --repos 1000 --port 8000, then run index.py with GITHUB_GRAPHQL_URL=http://127.0.0.1:8000/graphql
+# Control endpoints: GET /_stats[?expected=1], POST /_push {"fraction": 0.1, "commits": 5}, POST /_reset
+ME = 'U_bench'
+OTHER = 'U_other'
+EPOCH = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+# A 1x1 grey PNG, served as the user's avatar
+AVATAR = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010800000000'
+                       '3a7e9b550000000a49444154789c63680000008200815be5c8a10000000049454e44ae426082')
+
+
+class SyntheticUser:
+    """
+    A user with repos repositories, whose histories average commits commits, of which a share of mine are by the user
+    Commits are derived from a hash of (seed, repository, position), so nothing is stored but the history lengths,
+    and an oid encodes its repository and position so anchored history pages can find their starting commit
+    """
+
+    def __init__(self, repos, commits, mine, seed):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.mine = mine
+        self.names = [f'bench/repo{i:05d}' for i in range(repos)]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        # most repositories are small and a few are large, and some are empty
+        self.counts = [0 if rng.random() < 0.05 else max(1, int(rng.expovariate(1 / commits))) for _ in range(repos)]
+        self.stars = [int(rng.paretovariate(1.5)) - 1 for _ in range(repos)]
+        self.pushed = [EPOCH + datetime.timedelta(hours=count, seconds=rng.randrange(86400)) for count in self.counts]
+        self.rng = rng
+
+    def digest(self, repo, k):
+        return hashlib.sha1(f'{self.seed}:{repo}:{k}'.encode('utf-8')).digest()
+
+    def is_mine(self, repo, k):
+        return self.digest(repo, k)[0] < 256 * self.mine
+
+    def oid(self, repo, k):
+        return f'{repo:08x}{k:08x}' + self.digest(repo, k).hex()[:24]
+
+    def commit(self, repo, k):
+        digest = self.digest(repo, k)
+        return {
+            'oid': self.oid(repo, k),
+            'committedDate': (EPOCH + datetime.timedelta(hours=k)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'author': {'user': {'id': ME if digest[0] < 256 * self.mine else OTHER}},
+            'deletions': digest[2] % 80,
+            'additions': digest[1] % 200,
+        }
+
+    def head(self, repo):
+        """
+        Returns the oid of the newest commit of a repository, or None if it's empty
+        """
+        return self.oid(repo, self.counts[repo] - 1) if self.counts[repo] else None
+
+    def history(self, repo, oid, cursor, author=None, first=100):
+        """
+        Returns a page of first commits of the history of commit oid, like CommitHistoryConnection
+        """
+        positions = range(int(oid[8:16], 16), -1, -1)
+        if author is not None:
+            positions = [k for k in positions if (author == ME) == self.is_mine(repo, k)]
+        return history_page(positions, cursor, lambda page: [self.commit(repo, k) for k in page], first)
+
+    def compare(self, repo, base, head):
+        """
+        Returns the status of head against base, like REST compare, and the commits head has and base doesn't, oldest first
+        """
+        start, end = int(base[8:16], 16), int(head[8:16], 16)
+        status = 'ahead' if end > start else 'identical' if end == start else 'behind'
+        return status, [self.oid(repo, k) for k in range(start + 1, end + 1)]
+
+    def commit_by_oid(self, repo, oid):
+        return self.commit(repo, int(oid[8:16], 16))
+
+    def exists(self, repo, oid):
+        try:
+            return oid == self.oid(repo, int(oid[8:16], 16)) and int(oid[8:16], 16) < self.counts[repo]
+        except ValueError:
+            return False
+
+    def push(self, fraction, commits):
+        """
+        Adds commits new commits to a random fraction of the repositories, and returns how many were changed
+        """
+        changed = self.rng.sample(range(len(self.names)), int(len(self.names) * fraction))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for repo in changed:
+            self.counts[repo] += commits
+            self.pushed[repo] = now
+        return len(changed)
+
+    def expected(self):
+        """
+        Returns the totals index.py should arrive at, to check the benchmarked runs
+        """
+        additions = deletions = my_commits = 0
+        for repo, count in enumerate(self.counts):
+            for k in range(count):
+                commit = self.commit(repo, k)
+                if commit['author']['user']['id'] == ME:
+                    additions += commit['additions']
+                    deletions += commit['deletions']
+                    my_commits += 1
+        return {'additions': additions, 'deletions': deletions, 'my_commits': my_commits, 'stars': sum(self.stars)}
+
+
+class GitFixtureUser:
+    """
+    A user whose repositories are the bare git repositories under directory, e.g. from make_git_fixtures.py
+    Commits by my_emails or the user's noreply address are the user's. Additions and deletions come from
+    git log --numstat, diffing merges against their first parent like LOC_ENGINE=git does
+    """
+
+    def __init__(self, directory, my_emails, login='bench'):
+        self.directory = directory
+        self.my_emails = {email.lower() for email in my_emails}
+        self.login = login
+        self.names = sorted(os.path.relpath(os.path.join(root, name), directory)[:-4]
+                            for root, dirs, _ in os.walk(directory) for name in dirs if name.endswith('.git'))
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.histories = {} # (repository, oid) -> commits, newest first
+        self.heads = [subprocess.run(['git', '-C', self.path(repo), 'rev-parse', '--verify', '--quiet', 'HEAD'],
+                                     capture_output=True, text=True).stdout.strip() or None for repo in range(len(self.names))]
+        self.counts = [len(self.log(repo, head)) if head else 0 for repo, head in enumerate(self.heads)]
+        self.stars = [0] * len(self.names)
+        self.pushed = [datetime.datetime.fromisoformat(self.log(repo, head)[0]['committedDate']) if head else EPOCH
+                       for repo, head in enumerate(self.heads)]
+
+    def path(self, repo):
+        return os.path.join(self.directory, self.names[repo] + '.git')
+
+    def is_mine(self, email):
+        email = email.lower()
+        return email in self.my_emails or re.fullmatch(r'([0-9]+\+)?' + re.escape(self.login.lower()) + r'@users\.noreply\.github\.com', email) is not None
+
+    def log(self, repo, oid):
+        """
+        Returns the history of commit oid, newest first, as CommitHistoryConnection nodes
+        """
+        if (repo, oid) not in self.histories:
+            output = subprocess.run(['git', '-C', self.path(repo), 'log', oid, '--format=%x00%H %ae %cI', '--numstat',
+                                     '--no-renames', '--diff-merges=first-parent'], capture_output=True, text=True, check=True).stdout
+            commits = []
+            for entry in output.split('\0')[1:]:
+                lines = entry.split('\n')
+                commit_oid, email, date = lines[0].split(' ')
+                additions = deletions = 0
+                for line in lines[1:]:
+                    if line:
+                        added, deleted, _ = line.split('\t', 2)
+                        additions += int(added) if added != '-' else 0
+                        deletions += int(deleted) if deleted != '-' else 0
+                commits.append({'oid': commit_oid, 'committedDate': date, 'author': {'user': {'id': ME if self.is_mine(email) else OTHER}},
+                                'deletions': deletions, 'additions': additions})
+            self.histories[(repo, oid)] = commits
+        return self.histories[(repo, oid)]
+
+    def head(self, repo):
+        return self.heads[repo]
+
+    def history(self, repo, oid, cursor, author=None, first=100):
+        commits = self.log(repo, oid)
+        if author is not None:
+            commits = [commit for commit in commits if commit['author']['user']['id'] == author]
+        return history_page(commits, cursor, list, first)
+
+    def compare(self, repo, base, head):
+        if subprocess.run(['git', '-C', self.path(repo), 'merge-base', '--is-ancestor', base, head], capture_output=True).returncode != 0:
+            return 'diverged', []
+        output = subprocess.run(['git', '-C', self.path(repo), 'rev-list', '--reverse', f'{base}..{head}'], capture_output=True, text=True, check=True).stdout
+        return 'ahead' if output else 'identical', output.split()
+
+    def commit_by_oid(self, repo, oid):
+        return next((commit for commit in self.log(repo, self.heads[repo]) if commit['oid'] == oid), None)
+
+    def exists(self, repo, oid):
+        return subprocess.run(['git', '-C', self.path(repo), 'cat-file', '-e', oid + '^{commit}'], capture_output=True).returncode == 0
+
+    def push(self, fraction, commits):
+        return 0 # the fixtures only change when they are regenerated
+
+    def expected(self):
+        mine = [commit for repo, head in enumerate(self.heads) if head for commit in self.log(repo, head) if commit['author']['user']['id'] == ME]
+        return {'additions': sum(commit['additions'] for commit in mine), 'deletions': sum(commit['deletions'] for commit in mine),
+                'my_commits': len(mine), 'stars': 0}
+
+
+def history_page(commits, cursor, nodes, first=100):
+    """
+    Returns the page of first commits after cursor, like CommitHistoryConnection. nodes turns a slice of commits into commit nodes
+    """
+    start = int(cursor) if cursor else 0
+    page = nodes(commits[start:start + first])
+    return {
+        'totalCount': len(commits),
+        'edges': [{'node': node} for node in page],
+        'pageInfo': {'endCursor': str(start + len(page)), 'hasNextPage': start + first < len(commits)},
+    }
+
+
+def contributions(seed, year):
+    """
+    Returns the user's contribution count in a year
+    """
+    return hashlib.sha1(f'{seed}:contributions:{year}'.encode('utf-8')).digest()[0] * 10
+
+
+def count_nodes(data):
+    """
+    Returns how many connection edges there are anywhere in a response
+    """
+    if isinstance(data, dict):
+        return sum(len(value) if key == 'edges' else count_nodes(value) for key, value in data.items())
+    return 0
+
+
+class MockGitHub:
+    """
+    Answers GraphQL requests for a SyntheticUser, and keeps the request statistics
+    """
+
+    def __init__(self, user, latency=0.0, error_rate=0.0, rate_limit=0, rate_window=60.0, seed=0, node_latency=0.0, timeout=10.0):
+        self.user = user
+        self.latency = latency
+        self.node_latency = node_latency
+        self.timeout = timeout
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.spent = 0
+        self.port = 0 # set by serve
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'requests': {}, 'bytes_in': 0, 'bytes_out': 0, 'bytes_uncompressed': 0, 'errors_502': 0, 'rate_limited': 0}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def budget(self, cost):
+        """
+        Spends cost points of the rate limit, and returns (allowed, remaining, reset time)
+        """
+        with self.lock:
+            now = time.time()
+            if now >= self.window_start + self.rate_window:
+                self.window_start, self.spent = now, 0
+            reset = self.window_start + self.rate_window
+            if not self.rate_limit:
+                return True, 5000, reset
+            if self.spent + cost > self.rate_limit:
+                return False, 0, reset
+            self.spent += cost
+            return True, self.rate_limit - self.spent, reset
+
+    def answer(self, query, variables):
+        """
+        Returns (kind, cost, data) for a GraphQL query
+        """
+        user = self.user
+        if 'fragment HistoryPage' in query:
+            data = {}
+            i = 0
+            while f'name{i}' in variables:
+                repo = user.index.get(f"{variables[f'owner{i}']}/{variables[f'name{i}']}")
+                cursor, author, first = variables.get(f'cursor{i}'), variables.get('author_id'), variables.get(f'first{i}', 100)
+                if repo is None:
+                    data[f'r{i}'] = None
+                elif f'anchor{i}' in variables:
+                    anchor = variables[f'anchor{i}']
+                    data[f'r{i}'] = {'object': {'oid': anchor, 'history': user.history(repo, anchor, cursor, author, first)} if user.exists(repo, anchor) else None}
+                elif user.head(repo) is None:
+                    data[f'r{i}'] = {'defaultBranchRef': None}
+                else:
+                    head = user.head(repo)
+                    data[f'r{i}'] = {'defaultBranchRef': {'target': {'oid': head, 'history': user.history(repo, head, cursor, author, first)}}}
+                i += 1
+            return 'batch_loc', max(1, i), data
+        if 'fragment CommitStats' in query: # c0: object(oid: $oid0), ...
+            repo = user.index.get(f"{variables['owner']}/{variables['name']}")
+            oids = [variables[f'oid{i}'] for i in range(sum(name.startswith('oid') for name in variables))]
+            return 'merged_commits', 1, {'repository': {f'c{i}': user.commit_by_oid(repo, oid) for i, oid in enumerate(oids)}}
+        if 'contributionsCollection' in query: # one alias per year, y2015: contributionsCollection(from: $from2015, ...)
+            years = [name[4:] for name in variables if name.startswith('from')]
+            collections = {f'y{year}': {'contributionCalendar': {'totalContributions': contributions(self.seed, year)}} for year in years}
+            return 'graph_commits', max(1, len(years)), {'user': collections}
+        if 'contributed: repositories' in query:
+            owned = self.repositories(None, 100, stars=True)
+            owned['totalCount'] = len(user.names)
+            return 'profile_getter', 1, {'user': {
+                'id': ME,
+                'createdAt': '2015-01-01T00:00:00Z',
+                'avatarUrl': f'http://127.0.0.1:{self.port}/avatar.png',
+                'followers': {'totalCount': 42},
+                'contributed': {'totalCount': len(user.names)},
+                'owned': owned,
+            }}
+        if 'defaultBranchRef' in query:
+            return 'loc_query', 1, {'user': {'repositories': self.repositories(variables.get('cursor'), variables.get('first', 60), history=True,
+                                                                             by_pushed='PUSHED_AT' in query)}}
+        if 'stargazers' in query:
+            repositories = self.repositories(variables.get('cursor'), variables.get('first', 100), stars=True)
+            repositories['totalCount'] = len(user.names)
+            return 'graph_repos_stars', 1, {'user': {'repositories': repositories}}
+        raise ValueError('Unsupported query: ' + query[:200])
+
+    def repositories(self, cursor, first, stars=False, history=False, by_pushed=False):
+        """
+        Returns a page of the user's repositories, like RepositoryConnection, most recently pushed first with by_pushed
+        """
+        user = self.user
+        start = int(cursor) if cursor else 0
+        order = range(len(user.names))
+        if by_pushed:
+            order = sorted(order, key=lambda repo: user.pushed[repo], reverse=True)
+        edges = []
+        for repo in order[start:start + first]:
+            node = {'nameWithOwner': user.names[repo]}
+            if by_pushed:
+                node['pushedAt'] = user.pushed[repo].strftime('%Y-%m-%dT%H:%M:%SZ')
+            if stars:
+                node['stargazers'] = {'totalCount': user.stars[repo]}
+            if history:
+                head = user.head(repo)
+                node['defaultBranchRef'] = {'target': {'oid': head, 'history': {'totalCount': user.counts[repo]}}} if head else None
+            edges.append({'node': node})
+        return {'edges': edges, 'pageInfo': {'endCursor': str(start + len(edges)), 'hasNextPage': start + first < len(user.names)}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.github.com
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.mock.count('bytes_uncompressed', len(payload))
+        self.send_response(status)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            payload = gzip.compress(payload)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.mock.count('bytes_out', len(payload))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/avatar.png':
+            etag = '"' + hashlib.sha1(AVATAR).hexdigest() + '"'
+            self.send_response(304 if self.headers.get('If-None-Match') == etag else 200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', '0' if self.headers.get('If-None-Match') == etag else str(len(AVATAR)))
+            self.end_headers()
+            if self.headers.get('If-None-Match') != etag:
+                self.wfile.write(AVATAR)
+            return
+        compare = re.fullmatch(r'/repos/(.+)/compare/([0-9a-f]+)\.\.\.([0-9a-f]+)', url.path)
+        if compare:
+            return self.compare(compare.group(1), compare.group(2), compare.group(3), parse_qs(url.query))
+        if url.path != '/_stats':
+            return self.send(404, {'message': 'Not Found'})
+        with self.mock.lock:
+            stats = json.loads(json.dumps(self.mock.stats))
+        if parse_qs(url.query).get('expected'):
+            stats['expected'] = self.mock.user.expected()
+        self.send(200, stats)
+
+    def compare(self, name, base, head, query):
+        """
+        Answers GET /repos/{owner}/{name}/compare/{base}...{head}?per_page=&page=, with only the fields merged_commits reads
+        """
+        repo = self.mock.user.index.get(name)
+        if repo is None:
+            return self.send(404, {'message': 'Not Found'})
+        status, oids = self.mock.user.compare(repo, base, head)
+        per_page, page = int(query.get('per_page', ['250'])[0]), int(query.get('page', ['1'])[0])
+        with self.mock.lock:
+            self.mock.stats['requests']['compare'] = self.mock.stats['requests'].get('compare', 0) + 1
+        self.send(200, {'status': status, 'ahead_by': len(oids), 'total_commits': len(oids),
+                        'commits': [{'sha': oid} for oid in oids[(page - 1) * per_page:page * per_page]]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        if path == '/_push':
+            options = json.loads(body or b'{}')
+            return self.send(200, {'changed': self.mock.user.push(options.get('fraction', 0.1), options.get('commits', 5))})
+        if path == '/_reset':
+            self.mock.reset()
+            return self.send(200, {})
+        if path != '/graphql':
+            return self.send(404, {'message': 'Not Found'})
+
+        mock = self.mock
+        mock.count('bytes_in', len(body))
+        if mock.latency:
+            time.sleep(mock.latency)
+        with mock.lock:
+            failed = mock.rng.random() < mock.error_rate
+        if failed:
+            mock.count('errors_502')
+            return self.send(502, {'message': 'Bad Gateway'})
+        request = json.loads(body)
+        kind, cost, data = mock.answer(request['query'], request.get('variables') or {})
+        if mock.node_latency: # bigger pages take longer, and time out like GitHub's do
+            delay = mock.node_latency * count_nodes(data)
+            time.sleep(min(delay, mock.timeout))
+            if delay > mock.timeout:
+                mock.count('errors_502')
+                return self.send(502, {'message': 'Bad Gateway'})
+        allowed, remaining, reset = mock.budget(cost)
+        headers = {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(int(reset) + 1)}
+        if not allowed:
+            mock.count('rate_limited')
+            return self.send(403, {'message': 'API rate limit exceeded'}, headers)
+        with mock.lock:
+            mock.stats['requests'][kind] = mock.stats['requests'].get(kind, 0) + 1
+        if 'rateLimit' in request['query']:
+            reset_at = datetime.datetime.fromtimestamp(int(reset) + 1, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            data['rateLimit'] = {'cost': cost, 'remaining': remaining, 'resetAt': reset_at}
+        self.send(200, {'data': data}, headers)
+
+
+def serve(mock, port=0):
+    """
+    Starts serving mock on 127.0.0.1:port in a background thread, and returns the server
+    """
+    handler = type('MockHandler', (Handler,), {'mock': mock})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    mock.port = server.server_address[1]
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock GitHub GraphQL API for the benchmarks')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--commits', type=float, default=30, help='average commits per repository')
+    parser.add_argument('--mine', type=float, default=0.7, help='share of the commits made by the benchmarked user')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every GraphQL response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of GraphQL requests answered with a 502')
+    parser.add_argument('--node-latency', type=float, default=0.0, help='seconds added per repository or commit in a response')
+    parser.add_argument('--timeout', type=float, default=10.0, help='responses that would take longer than this many seconds are 502s')
+    parser.add_argument('--rate-limit', type=int, default=0, help='points per rate-limit window, 0 for no limit')
+    parser.add_argument('--rate-window', type=float, default=60.0, help='seconds per rate-limit window')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--git-fixtures', help='serve the bare git repositories in this directory instead of a synthetic user')
+    parser.add_argument('--my-emails', default='bench@example.com', help="comma-separated emails of the user's commits in the fixtures")
+    args = parser.parse_args()
+
+    if args.git_fixtures:
+        user = GitFixtureUser(args.git_fixtures, args.my_emails.split(','))
+    else:
+        user = SyntheticUser(args.repos, args.commits, args.mine, args.seed)
+    server = serve(MockGitHub(user, args.latency, args.error_rate, args.rate_limit, args.rate_window, args.seed,
+                              args.node_latency, args.timeout), args.port)
+    print(f'Listening on http://127.0.0.1:{server.server_address[1]}/graphql', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
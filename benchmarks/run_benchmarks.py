@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+# Offline benchmarks for index.py, run against benchmarks/mock_github.py instead of the live API
+# For every user size it measures:
+# - the stats queries (profile_getter)
+# - loc_query/cache_builder: cold (no cache), warm (nothing changed) and incremental (new commits in some repositories)
+# - rendering both SVGs
+# Each stage reports wall time, GraphQL requests, bytes sent and received, and peak Python memory (tracemalloc).
+# Usage: python benchmarks/run_benchmarks.py --repos 10,100,1000,10000 [--latency 0.05] [--error-rate 0.01] [--node-latency 0.002 --timeout 1] [--rate-limit 500 --rate-window 5]
+# To compare the LOC engines on the same histories, create fixtures with make_git_fixtures.py and run with
+# --git-fixtures DIR, once with --engine graphql and once with --engine git
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK = os.path.join(ROOT, 'benchmarks', 'mock_github.py')
+AFFILIATIONS = ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER']
+
+os.environ.setdefault('ACCESS_TOKEN', 'benchmark')
+os.environ.setdefault('USER_NAME', 'bench')
+sys.path.insert(0, ROOT)
+
+
+def start_mock(args, repos):
+    """
+    Starts mock_github.py in its own process, so it doesn't count towards the measured memory, and returns it with its URL
+    """
+    command = [sys.executable, MOCK, '--repos', str(repos), '--commits', str(args.commits), '--mine', str(args.mine),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--node-latency', str(args.node_latency), '--timeout', str(args.timeout),
+               '--rate-limit', str(args.rate_limit), '--rate-window', str(args.rate_window), '--seed', str(args.seed)]
+    if args.git_fixtures:
+        command += ['--git-fixtures', args.git_fixtures, '--my-emails', args.my_emails]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().split()[-1]
+    return process, url
+
+
+def control(url, path, body=None):
+    """
+    Calls one of the mock server's control endpoints and returns its JSON answer
+    """
+    base = url.rsplit('/', 1)[0]
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    with urllib.request.urlopen(urllib.request.Request(base + path, data=data, method='GET' if data is None else 'POST')) as response:
+        return json.loads(response.read())
+
+
+def measure(url, name, funct, *args, verbose=False, memory=True):
+    """
+    Runs funct(*args) and returns its result with wall time, requests, bytes and peak memory
+    """
+    import index
+    control(url, '/_reset', {})
+    for key in index.QUERY_COUNT:
+        index.QUERY_COUNT[key] = 0
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.nullcontext() if verbose else contextlib.redirect_stdout(devnull):
+        result = funct(*args)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    if memory:
+        tracemalloc.stop()
+    stats = control(url, '/_stats')
+    return result, {
+        'stage': name,
+        'wall_s': round(wall, 4),
+        'requests': sum(stats['requests'].values()),
+        'requests_by_query': stats['requests'],
+        'errors_502': stats['errors_502'],
+        'rate_limited': stats['rate_limited'],
+        'bytes_sent': stats['bytes_in'],
+        'bytes_received': stats['bytes_out'],
+        'bytes_uncompressed': stats['bytes_uncompressed'],
+        'peak_memory_mb': None if peak is None else round(peak / 2 ** 20, 2),
+    }
+
+
+def fresh_run():
+    """
+    Forgets what index.py loaded in memory, as if the next stage was a new run reading the cache from disk
+    """
+    import index
+    import telemetry
+    index.CACHE = None
+    index.CHECKPOINTS.clear()
+    index.PROFILE.clear()
+    index.TEMPLATES.clear()
+    index.PAGE_SIZES = None
+    index.FAST_PAGES.clear()
+    telemetry.SPANS.clear()
+
+
+def synthetic_avatar():
+    """
+    Returns a 460x460 RGBA gradient with a transparent border, in place of a background-removed avatar
+    """
+    import numpy as np
+    y, x = np.mgrid[0:460, 0:460]
+    rgba = np.stack([x * 255 // 459, y * 255 // 459, (x + y) * 255 // 918, np.full(x.shape, 255)], axis=2).astype(np.uint8)
+    rgba[(x - 230) ** 2 + (y - 230) ** 2 > 200 ** 2] = 0
+    return rgba
+
+
+def render(grid):
+    import index
+    loc = ['{:,}'.format(value) for value in (1880527, 353922, 1526605)]
+    index.svg_overwrite(['dark_mode.svg', 'light_mode.svg'], index.load_config('config.json'), '34', 1153, 10, 20, 30, 40, loc, grid)
+
+
+def bench_user(args, repos):
+    """
+    Runs every stage against a mock user with repos repositories, in a scratch directory, and returns the results
+    """
+    import github_client
+    import index
+    process, url = start_mock(args, repos)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    cwd = os.getcwd()
+    try:
+        github_client.GRAPHQL_URL = url
+        github_client.REST_URL = url.rsplit('/', 1)[0]
+        index.LOC_ENGINE = args.engine
+        if args.git_fixtures:
+            index.GIT_REMOTE_URL = 'file://' + os.path.abspath(args.git_fixtures) + '/{name}.git'
+            index.GIT_AUTHOR_EMAILS = args.my_emails.split(',')
+        shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(workdir, 'templates'))
+        shutil.copy(os.path.join(ROOT, 'config.json'), workdir)
+        os.makedirs(os.path.join(workdir, 'cache'))
+        os.chdir(workdir)
+        options = {'verbose': args.verbose, 'memory': not args.no_memory}
+        results = []
+
+        fresh_run()
+        profile, result = measure(url, 'stats', index.profile_getter, index.USER_NAME, **options)
+        index.OWNER_ID = {'id': profile['id']}
+        results.append(result)
+
+        expected = control(url, '/_stats?expected=1')['expected']
+        for stage in ('loc cold', 'loc warm', 'loc incremental'):
+            if stage == 'loc incremental':
+                control(url, '/_push', {'fraction': args.push, 'commits': args.push_commits})
+                expected = control(url, '/_stats?expected=1')['expected']
+            fresh_run()
+            total_loc, result = measure(url, stage, index.loc_query, AFFILIATIONS, 7, **options)
+            commits = index.commit_counter(7)
+            result['correct'] = [total_loc[0], total_loc[1], commits] == [expected['additions'], expected['deletions'], expected['my_commits']]
+            results.append(result)
+
+        fresh_run()
+        grid = index.render_ascii_grid(synthetic_avatar())
+        _, result = measure(url, 'svg render', render, grid, **options)
+        results.append(result)
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        process.terminate()
+        process.wait()
+
+
+def print_results(repos, results):
+    print(f'\n{repos:,} repositories' if repos else '\nGit fixtures')
+    print('{:<17}{:>10}{:>10}{:>12}{:>12}{:>10}{:>9}'.format('stage', 'wall s', 'requests', 'sent kB', 'recv kB', 'peak MB', 'correct'))
+    for result in results:
+        peak = '-' if result['peak_memory_mb'] is None else '%.2f' % result['peak_memory_mb']
+        correct = {True: 'yes', False: 'NO', None: ''}[result.get('correct')]
+        print('{:<17}{:>10.3f}{:>10}{:>12.1f}{:>12.1f}{:>10}{:>9}'.format(
+            result['stage'], result['wall_s'], result['requests'], result['bytes_sent'] / 1024, result['bytes_received'] / 1024, peak, correct))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark index.py against a local mock of the GitHub GraphQL API')
+    parser.add_argument('--repos', default='10,100,1000,10000', help='comma-separated repository counts, one mock user each')
+    parser.add_argument('--commits', type=float, default=30, help='average commits per repository')
+    parser.add_argument('--mine', type=float, default=0.7, help='share of the commits made by the benchmarked user')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every GraphQL response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of GraphQL requests answered with a 502')
+    parser.add_argument('--node-latency', type=float, default=0.0, help='seconds added per repository or commit in a GraphQL response')
+    parser.add_argument('--timeout', type=float, default=10.0, help='GraphQL responses slower than this many seconds are 502s')
+    parser.add_argument('--rate-limit', type=int, default=0, help='points per rate-limit window, 0 for no limit')
+    parser.add_argument('--rate-window', type=float, default=60.0, help='seconds per rate-limit window')
+    parser.add_argument('--push', type=float, default=0.1, help='share of repositories that get new commits before the incremental run')
+    parser.add_argument('--push-commits', type=int, default=5, help='new commits per changed repository')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--engine', choices=['graphql', 'git'], default='graphql', help='LOC_ENGINE to benchmark')
+    parser.add_argument('--git-fixtures', help='benchmark the bare git repositories in this directory instead of synthetic users')
+    parser.add_argument('--my-emails', default='bench@example.com', help="comma-separated emails of the user's commits in the fixtures")
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows Python code down, for cleaner wall times')
+    parser.add_argument('--verbose', action='store_true', help="keep index.py's own output")
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+    if args.engine == 'git' and not args.git_fixtures:
+        parser.error('--engine git needs --git-fixtures, since the synthetic users have no repositories to clone')
+
+    report = {'options': vars(args), 'users': {}}
+    for repos in [0] if args.git_fixtures else [int(count) for count in args.repos.split(',')]:
+        results = bench_user(args, repos)
+        print_results(repos, results)
+        report['users'][repos] = results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
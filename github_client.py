@@ -0,0 +1,186 @@
+import datetime
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import telemetry
+
+# Shared HTTP client for index.py
+# Every request goes through one pooled Session, so connections to api.github.com are kept alive and reused,
+# and requests are paced by the rate-limit budget GitHub reports instead of fixed sleeps.
+GRAPHQL_URL = os.environ.get('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql')  # Overridable, e.g. to point the benchmarks at a local mock server
+REST_URL = os.environ.get('GITHUB_REST_URL', 'https://api.github.com')  # Root of the REST API, for what GraphQL can't answer (see rest)
+HEADERS = {} # GraphQL auth headers, from ACCESS_TOKEN on the first request. Kept off the Session so the token is never sent to the avatar host
+POOL_SIZE = 16
+TIMEOUT = 20
+RETRY_RANGE = 5
+LOW_BUDGET = 100  # Below this many remaining points, requests are spread out over the time left until the limit resets
+MIN_INTERVAL = 0.0  # Floor on the seconds between two requests, regardless of the budget
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+SESSION.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+BUDGET = {'remaining': None, 'reset': 0.0, 'retry_after': 0.0}
+BUDGET_LOCK = threading.Lock()
+NEXT_REQUEST_TIME = 0.0
+FIRST_REQUEST_TIME = None  # time.perf_counter() when the first GraphQL request was sent, to report startup time
+
+
+def pace():
+    """
+    Waits as long as the rate-limit budget requires before the next request
+    With plenty of budget left this doesn't wait at all. When the remaining budget gets low, requests are spread evenly
+    over the time left until the limit resets, and a Retry-After from GitHub is always waited out
+    """
+    global NEXT_REQUEST_TIME
+    with BUDGET_LOCK:
+        now = time.time()
+        interval = MIN_INTERVAL
+        if BUDGET['remaining'] is not None and BUDGET['remaining'] < LOW_BUDGET:
+            interval = max(interval, (BUDGET['reset'] - now) / max(1, BUDGET['remaining']))
+        slot = max(now, NEXT_REQUEST_TIME, BUDGET['retry_after'])
+        NEXT_REQUEST_TIME = slot + interval
+    if slot > now:
+        print(f"Pacing requests for the rate limit, waiting {slot - now:.1f} s...", flush=True)
+        time.sleep(slot - now)
+
+
+def update_budget(response):
+    """
+    Records the rate-limit budget from the X-RateLimit-* and Retry-After headers,
+    and from the rateLimit { cost remaining resetAt } field when the query asked for it, which is returned
+    """
+    headers = response.headers
+    with BUDGET_LOCK:
+        if 'X-RateLimit-Remaining' in headers:
+            BUDGET['remaining'] = int(headers['X-RateLimit-Remaining'])
+        if 'X-RateLimit-Reset' in headers:
+            BUDGET['reset'] = float(headers['X-RateLimit-Reset'])
+        if 'Retry-After' in headers:
+            BUDGET['retry_after'] = time.time() + float(headers['Retry-After'])
+        elif response.status_code in (403, 429) and BUDGET['remaining'] == 0:
+            BUDGET['retry_after'] = BUDGET['reset']
+    if response.status_code == 200:
+        try:
+            rate_limit = (response.json().get('data') or {}).get('rateLimit')
+        except ValueError:
+            return None
+        if rate_limit:
+            with BUDGET_LOCK:
+                BUDGET['remaining'] = rate_limit['remaining']
+                BUDGET['reset'] = datetime.datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+        return rate_limit
+    return None
+
+
+def rate_limited(response):
+    """
+    Returns True if GitHub turned the request down because of a rate limit, rather than because it failed
+    GitHub reports the primary limit either as a 403/429 or as a 200 with a RATE_LIMITED error
+    """
+    if response.status_code in (403, 429):
+        return 'Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0'
+    if response.status_code == 200:
+        try:
+            errors = response.json().get('errors') or []
+        except ValueError:
+            return False
+        if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+            with BUDGET_LOCK:
+                BUDGET['retry_after'] = max(BUDGET['retry_after'], BUDGET['reset'])
+            return True
+    return False
+
+
+def post(func_name, query, variables, trace=None, on_gateway_error=None):
+    """
+    Sends a GraphQL query and returns the response, or raises an Exception if the response does not succeed.
+    Gateway errors are retried with exponential backoff, and rate-limited requests are retried once the budget allows
+    A gateway error is retried with the variables on_gateway_error(variables) returns, if given, e.g. to ask for a smaller page
+    Every call is recorded as a telemetry span with its status, retries, bytes and cost, plus the attributes in trace
+    """
+    start = time.perf_counter()
+    span = {'statuses': [], 'bytes': 0, 'cost': None, **(trace or {})}
+    try:
+        return send(func_name, query, variables, span, on_gateway_error)
+    finally:
+        span['status'] = span['statuses'][-1] if span['statuses'] else None
+        span['retries'] = max(0, len(span['statuses']) - 1)
+        telemetry.record(func_name, 'request', start, time.perf_counter() - start, **span)
+
+
+def send(func_name, query, variables, span, on_gateway_error=None):
+    """
+    Does the work of post, filling in the span
+    """
+    global FIRST_REQUEST_TIME
+    if not HEADERS: # read here rather than at import, so runs that make no requests don't need a token
+        HEADERS['Authorization'] = 'token ' + os.environ['ACCESS_TOKEN']
+    for attempt in range(RETRY_RANGE):
+        pace()
+        if FIRST_REQUEST_TIME is None:
+            FIRST_REQUEST_TIME = time.perf_counter()
+        print(f"Making request in {func_name} (attempt {attempt + 1}/{RETRY_RANGE})...", flush=True)
+        response = SESSION.post(GRAPHQL_URL, json={'query': query, 'variables': variables}, headers=HEADERS, timeout=TIMEOUT)
+        span['statuses'].append(response.status_code)
+        span['bytes'] += len(response.content)
+        rate_limit = update_budget(response)
+        if rate_limit:
+            span['cost'] = rate_limit.get('cost')
+        if rate_limited(response):
+            print(f"API request in {func_name} was rate limited, attempt {attempt + 1}/{RETRY_RANGE}. Retrying when the limit resets...", flush=True)
+            continue
+        if response.status_code == 200:
+            return response
+        if response.status_code in (502, 503, 504):  # Retry on gateway errors
+            print(f"API request in {func_name} failed with status {response.status_code}, attempt {attempt + 1}/{RETRY_RANGE}. Retrying after delay...", flush=True)
+            time.sleep(2 ** attempt)  # Exponential backoff
+            if on_gateway_error:
+                variables = on_gateway_error(variables)
+            continue
+        if response.status_code == 403:
+            raise Exception('Too many requests in a short amount of time!\nYou\'ve hit the non-documented anti-abuse limit!')
+        raise Exception(func_name, ' has failed with a', response.status_code, response.text)
+    # If all retries fail
+    raise Exception(func_name, f' failed after {RETRY_RANGE} retries with status', response.status_code, response.text)
+
+
+def rest(func_name, path, params=None, trace=None):
+    """
+    Sends a GET request to the REST API (path like '/repos/owner/name/...') and returns the response, or raises an Exception if it does not succeed
+    Gateway errors are retried with exponential backoff. The REST API has its own rate limit, so BUDGET isn't updated from it
+    Every call is recorded as a telemetry span, like post's
+    """
+    start = time.perf_counter()
+    span = {'statuses': [], 'bytes': 0, 'cost': None, **(trace or {})}
+    if not HEADERS:
+        HEADERS['Authorization'] = 'token ' + os.environ['ACCESS_TOKEN']
+    try:
+        for attempt in range(RETRY_RANGE):
+            pace()
+            print(f"Making request in {func_name} (attempt {attempt + 1}/{RETRY_RANGE})...", flush=True)
+            response = SESSION.get(REST_URL + path, params=params, headers=HEADERS, timeout=TIMEOUT)
+            span['statuses'].append(response.status_code)
+            span['bytes'] += len(response.content)
+            if response.status_code == 200:
+                return response
+            if response.status_code in (502, 503, 504):
+                print(f"API request in {func_name} failed with status {response.status_code}, attempt {attempt + 1}/{RETRY_RANGE}. Retrying after delay...", flush=True)
+                time.sleep(2 ** attempt)
+                continue
+            raise Exception(func_name, ' has failed with a', response.status_code, response.text)
+        raise Exception(func_name, f' failed after {RETRY_RANGE} retries with status', response.status_code, response.text)
+    finally:
+        span['status'] = span['statuses'][-1] if span['statuses'] else None
+        span['retries'] = max(0, len(span['statuses']) - 1)
+        telemetry.record(func_name, 'request', start, time.perf_counter() - start, **span)
+
+
+def get(url, timeout=10, headers=None):
+    """
+    Downloads a file through the shared Session, without the GraphQL auth headers
+    """
+    return SESSION.get(url, timeout=timeout, headers=headers)
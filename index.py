@@ -1,18 +1,27 @@
+import time
+START_TIME = time.perf_counter()  # Startup time is measured from here to the first GitHub request
 import datetime
-from dateutil import relativedelta
-from ascii_magic import AsciiArt
-import requests
+import github_client
+import telemetry
 import os
-from lxml import etree
-import time
+import sys
 import hashlib
 import json
 from io import BytesIO
-from PIL import Image
-import numpy as np
-import rembg
 import re
 import pytz
+import threading
+import signal
+import tempfile
+import queue
+import copy
+import itertools
+import subprocess
+import base64
+import functools
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, FIRST_EXCEPTION
 
 # CREDIT TO https://github.com/Andrew6rant
 
@@ -20,12 +29,64 @@ import pytz
 # Account permissions: read:Followers, read:Starring, read:Watching
 # Repository permissions: read:Commit statuses, read:Contents, read:Issues, read:Metadata, read:Pull Requests
 # Issues and pull requests permissions not needed at the moment, but may be used in the future
-HEADERS = {'Authorization': 'token '+ os.environ['ACCESS_TOKEN']}
-USER_NAME = os.environ['USER_NAME']
-QUERY_COUNT = {'user_getter': 0, 'follower_getter': 0, 'graph_repos_stars': 0, 'recursive_loc': 0, 'graph_commits': 0, 'loc_query': 0}
+# ACCESS_TOKEN is read by github_client when the first request is made
+USER_NAMES = [name for name in os.environ.get('USER_NAMES', '').split(',') if name]  # Batch mode: a card for each of these users, see batch_main
+USER_NAME = USER_NAMES[0] if USER_NAMES else os.environ['USER_NAME']  # Whose card is being made. batch_main switches it from user to user
+QUERY_COUNT = {'profile_getter': 0, 'graph_repos_stars': 0, 'batch_loc': 0, 'graph_commits': 0, 'loc_query': 0, 'merged_commits': 0}
 ASCII_GEN_COLS = 60
 ASCII_PRINT_COLS = 38
 ASCII_MAX_LINES = 25
+ASCII_WIDTH_RATIO = 2
+AVATAR_CACHE_DIR = 'cache/avatar'  # Background-removed avatar and its ASCII art, keyed by content hash
+ASCII_CHARS = ' .`-_\':,;^=+/"|)\\<>)iv%xclrs{*}I?!][1taeo7zjLunT#JCwfy325Fp6mqSghVd4EgXPGZbYkOA&8U$@KHDBWNMR0QQ'  # Darkest to brightest
+ASCII_HTML = os.environ.get('ASCII_HTML', '1') == '1'  # Also write the avatar art to ascii.html
+BIRTHDAY = datetime.datetime(1991, 11, 20)
+ROLLUP_EPOCH = 2008  # My commits are also summed per month, counting months from January of this year (GitHub's first)
+CONTRIBUTION_GRACE = datetime.timedelta(days=7)  # How long after a year ends its contribution count is considered final
+RENDER_ONLY = os.environ.get('RENDER_ONLY', '0') == '1'  # Only rebuild the SVGs and stats.json from the cache and the last stats.json, without a token or any request
+OUTPUT_DIR = '' # Where the SVGs, stats.json and ascii.html are written. batch_main gives each user their own
+UMASK = os.umask(0o022) # The umask can only be read by setting it, so it is set straight back. New files get 0o666 minus it, see write_file_atomic
+os.umask(UMASK)
+BATCH_DIR = os.environ.get('BATCH_DIR', 'cards')  # Batch mode writes each user's card to BATCH_DIR/<user>/, with their config.json there if they have one
+SVG_TEMPLATE_DIR = 'templates'  # The SVGs are rendered from the templates here into the files of the same name in the repository root
+TEMPLATES = {} # template path -> parsed template, so each template is only parsed once. Every render works on a copy of it
+AVATAR_COLOR_TOLERANCE = float(os.environ.get('AVATAR_COLOR_TOLERANCE', 2.3))  # Avatar colors closer than this CIE76 delta E are drawn as one. 2.3 is about the smallest difference the eye can see
+LOC_WORKERS = int(os.environ.get('LOC_WORKERS', 4))  # How many repositories cache_builder refreshes at the same time
+LOC_BATCH_SIZE = int(os.environ.get('LOC_BATCH_SIZE', 5))  # How many repositories each history request starts out fetching
+LOC_BATCH_MAX = 10  # Batches never grow past this, since every repository in a batch adds 100 commits of diff stats to the response
+QUERY_COST_TARGET = 10  # Batches shrink when GitHub reports a query cost higher than this
+AUTHOR_FILTER = os.environ.get('AUTHOR_FILTER', '0') == '1'  # Ask GitHub for only my commits, instead of filtering every commit locally
+FULL_SCAN_DAYS = float(os.environ.get('FULL_SCAN_DAYS', 7))  # Days between runs that page every repository. Runs in between only page the ones pushed since the last run
+FULL_SCAN = os.environ.get('FULL_SCAN', '0') == '1'  # Page every repository this run, e.g. from a manually dispatched workflow
+PAGE_SIZE_DEFAULTS = {'loc_query': 60, 'graph_repos_stars': 100, 'history': 100}  # Starting page sizes, per query and for every repository's history
+PAGE_SIZE_MIN = 5
+PAGE_SIZE_MAX = 100  # GitHub's limit on first
+SLOW_RESPONSE = float(os.environ.get('SLOW_RESPONSE', 5))  # A page that takes longer than this many seconds shrinks the next one, well before GitHub's 10 s timeout
+FAST_STREAK = 3  # A page size grows again after this many fast pages in a row
+LOC_ENGINE = os.environ.get('LOC_ENGINE', 'graphql')  # 'graphql' pages histories through the API, 'git' counts them in local mirrors
+GIT_MIRROR_DIR = os.environ.get('GIT_MIRROR_DIR', 'mirrors')  # Blobless bare mirrors of my repositories, for LOC_ENGINE=git
+GIT_REMOTE_URL = os.environ.get('GIT_REMOTE_URL', 'https://github.com/{name}.git')  # {name} is owner/repo, e.g. file:///fixtures/{name}.git for local repositories
+GIT_AUTHOR_EMAILS = [email for email in os.environ.get('GIT_AUTHOR_EMAILS', '').split(',') if email]  # My commit emails, besides my GitHub noreply address
+telemetry.ORIGIN = START_TIME
+TRACE_FILE = 'trace.json'  # Telemetry spans of the run, next to stats.json
+TRACE_CHROME = os.environ.get('TRACE_CHROME', '0') == '1'  # Also export them as trace.chrome.json, for chrome://tracing, Perfetto or speedscope
+github_client.MIN_INTERVAL = float(os.environ.get('REQUEST_INTERVAL', 0))  # Optional floor on the seconds between requests, on top of rate-limit pacing
+COUNT_LOCK = threading.Lock()
+PROFILE = {} # username -> profile_getter result, so the profile is only queried once per run
+CACHE = None # repository hash -> cache row, loaded once per run by load_cache
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 30))  # Seconds between saves of the cache and the in-progress histories
+CHECKPOINTS = {} # repository hash -> pagination state of a history that hasn't finished paging, loaded by load_cache
+CHECKPOINT_LOCK = threading.Lock()
+LAST_CHECKPOINT = time.monotonic()
+PAGE_SIZES = None # query name or repository hash -> learned page size, loaded by page_size from the cache directory
+FAST_PAGES = {} # query name or repository hash -> fast pages in a row at its current size
+PAGE_SIZE_LOCK = threading.Lock()
+SHARED_STORE = False # True while batch_main updates the shared store of every user's repositories, instead of one user's cache
+AUTHORS = {} # repository hash -> {author ID: [commits, LOC added, LOC deleted]}, the shared store's per-author sums
+ROLLUPS = {} # repository hash -> [first month, [my commits], [LOC added], [LOC deleted]], one entry per month from the first, loaded by load_cache
+SHUTDOWN = threading.Event() # set when the run is interrupted or a stage fails, so the stages still running stop early
+REMBG_SESSION = None # created once by rembg_session, and only when the avatar isn't cached
+REMBG_LOCK = threading.Lock()
 
 def load_config(file_path='config.json'):
     try:
@@ -45,6 +106,7 @@ def daily_readme(birthday):
     Returns the length of time since I was born
     e.g. 'XX years, XX months, XX days'
     """
+    from dateutil import relativedelta
     diff = relativedelta.relativedelta(datetime.datetime.today(), birthday)
     return str(diff.years)
 
@@ -61,46 +123,148 @@ def format_plural(unit):
     return 's' if unit != 1 else ''
 
 
-def simple_request(func_name, query, variables):
+def simple_request(func_name, query, variables, trace=None, on_gateway_error=None):
     """
     Returns a request, or raises an Exception if the response does not succeed.
+    Requests go through the shared client, which retries gateway errors and paces requests to the rate limit
+    trace is added to the request's telemetry span, e.g. which repositories or page it was for
+    on_gateway_error returns the variables to retry a gateway error with, e.g. with a smaller page
     """
-    print(f"Making request in {func_name}...")
-    request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables':variables}, headers=HEADERS, timeout=20)  # Add timeout=20
-    if request.status_code == 200:
-        return request
-    raise Exception(func_name, ' has failed with a', request.status_code, request.text, QUERY_COUNT)
+    return github_client.post(func_name, query, variables, trace, on_gateway_error)
 
 
-def graph_commits(start_date, end_date):
+def paginate(func_name, query, variables, connection):
+    """
+    Yields every page of a paginated GraphQL connection, following pageInfo one request at a time
+    connection picks the connection out of the response data, e.g. lambda data: data['user']['repositories']
+    The next page is only requested once the previous one has been consumed, and pages aren't kept,
+    so stack depth and memory stay constant however many pages there are
+    The query takes its page size as $first, which adapts to how GitHub copes with this query (see page_size)
     """
-    Uses GitHub's GraphQL v4 API to return my total commit count
+    variables = dict(variables)
+    shrink = lambda variables: {**variables, 'first': shrink_page(func_name)}
+    for page_number in itertools.count(1):
+        query_count(func_name)
+        variables['first'] = page_size(func_name)
+        response = simple_request(func_name, query, variables, {'page': page_number}, shrink)
+        page_timed(func_name, response.elapsed.total_seconds())
+        page = connection(response.json()['data'])
+        yield page
+        if not page['pageInfo']['hasNextPage']:
+            return
+        variables['cursor'] = page['pageInfo']['endCursor']
+
+
+def page_size(key):
+    """
+    Returns the page size to request for key, a query name or a repository hash for its history
+    Sizes shrink on gateway errors and slow responses and grow back after FAST_STREAK fast pages, and are saved by checkpoint,
+    so the next run starts at the size this one learned
+    """
+    global PAGE_SIZES
+    with PAGE_SIZE_LOCK:
+        if PAGE_SIZES is None:
+            try:
+                with open(page_size_file_name(), 'r') as f:
+                    PAGE_SIZES = json.load(f)
+            except FileNotFoundError:
+                PAGE_SIZES = {}
+        return PAGE_SIZES.get(key, PAGE_SIZE_DEFAULTS.get(key, PAGE_SIZE_DEFAULTS['history']))
+
+
+def shrink_page(key):
+    """
+    Halves the page size of key, and returns the new size
+    """
+    size = max(PAGE_SIZE_MIN, page_size(key) // 2)
+    with PAGE_SIZE_LOCK:
+        PAGE_SIZES[key] = size
+        FAST_PAGES[key] = 0
+    print(f"Shrinking {key[:12]} pages to {size}", flush=True)
+    return size
+
+
+def page_timed(key, seconds):
+    """
+    Adapts the page size of key to a page that GitHub took seconds to answer
+    """
+    size = page_size(key)
+    if seconds > SLOW_RESPONSE:
+        shrink_page(key)
+        return
+    with PAGE_SIZE_LOCK:
+        FAST_PAGES[key] = FAST_PAGES.get(key, 0) + 1
+        if FAST_PAGES[key] >= FAST_STREAK and size < PAGE_SIZE_MAX:
+            PAGE_SIZES[key] = min(PAGE_SIZE_MAX, size * 3 // 2)
+            FAST_PAGES[key] = 0
+
+
+def graph_commits(windows):
+    """
+    Uses GitHub's GraphQL v4 API to return my contribution count in each of windows, a list of (year, start, end) datetimes
+    contributionsCollection only covers up to a year at a time, so every window gets its own alias (y2015, y2016, ...),
+    and all of them are fetched with one request. Returns {year: contributions}
     """
     query_count('graph_commits')
-    query = '''
-    query($start_date: DateTime!, $end_date: DateTime!, $login: String!) {
-        user(login: $login) {
-            contributionsCollection(from: $start_date, to: $end_date) {
-                contributionCalendar {
+    arguments = ''.join(f', $from{year}: DateTime!, $to{year}: DateTime!' for year, __, __ in windows)
+    collections = ''.join(f'''
+            y{year}: contributionsCollection(from: $from{year}, to: $to{year}) {{
+                contributionCalendar {{
                     totalContributions
-                }
-            }
+                }}
+            }}''' for year, __, __ in windows)
+    query = '''
+    query($login: String!''' + arguments + ''') {
+        user(login: $login) {''' + collections + '''
+        }
+        rateLimit {
+            cost
+            remaining
+            resetAt
         }
     }'''
-    variables = {'start_date': start_date,'end_date': end_date, 'login': USER_NAME}
-    request = simple_request(graph_commits.__name__, query, variables)
-    return int(request.json()['data']['user']['contributionsCollection']['contributionCalendar']['totalContributions'])
+    variables = {'login': USER_NAME}
+    for year, start, end in windows:
+        variables.update({f'from{year}': start.isoformat(), f'to{year}': end.isoformat()})
+    user = simple_request(graph_commits.__name__, query, variables, {'years': [year for year, __, __ in windows]}).json()['data']['user']
+    return {year: int(user[f'y{year}']['contributionCalendar']['totalContributions']) for year, __, __ in windows}
+
+
+def contribution_counter(profile):
+    """
+    Returns my lifetime contribution count, from the year the account was created until now
+    A year is stored in the contributions cache once it ended more than CONTRIBUTION_GRACE ago (so late pushes and time zones
+    have settled), and is never queried again. Later runs therefore only query the current year, plus any year not stored yet
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    created = datetime.datetime.fromisoformat(profile['created_at'].replace('Z', '+00:00'))
+    try:
+        with open(contributions_file_name(), 'r') as f:
+            closed = {int(year): total for year, total in json.load(f).items()}
+    except FileNotFoundError:
+        closed = {}
+    windows = []
+    for year in range(created.year, now.year + 1):
+        if year not in closed:
+            start = max(created, datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc))
+            windows.append((year, start, datetime.datetime(year, 12, 31, 23, 59, 59, tzinfo=datetime.timezone.utc)))
+    totals = graph_commits(windows) if windows else {}
+    newly_closed = {year: total for year, total in totals.items()
+                    if now - datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc) > CONTRIBUTION_GRACE}
+    if newly_closed:
+        closed.update(newly_closed)
+        write_file_atomic(contributions_file_name(), json.dumps({str(year): total for year, total in sorted(closed.items())}, indent=1))
+    return sum(closed.values()) + sum(total for year, total in totals.items() if year not in closed)
 
 
 def graph_repos_stars(count_type, owner_affiliation, cursor=None, add_loc=0, del_loc=0):
     """
     Uses GitHub's GraphQL v4 API to return my total repository, star, or lines of code count.
     """
-    query_count('graph_repos_stars')
     query = '''
-    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
+    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String, $first: Int!) {
         user(login: $login) {
-            repositories(first: 100, after: $cursor, ownerAffiliations: $owner_affiliation) {
+            repositories(first: $first, after: $cursor, ownerAffiliations: $owner_affiliation) {
                 totalCount
                 edges {
                     node {
@@ -118,113 +282,526 @@ def graph_repos_stars(count_type, owner_affiliation, cursor=None, add_loc=0, del
                 }
             }
         }
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
     }'''
     variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(graph_repos_stars.__name__, query, variables)
-    if request.status_code == 200:
-        if count_type == 'repos':
-            return request.json()['data']['user']['repositories']['totalCount']
-        elif count_type == 'stars':
-            return stars_counter(request.json()['data']['user']['repositories']['edges'])
+    pages = paginate(graph_repos_stars.__name__, query, variables, lambda data: data['user']['repositories'])
+    if count_type == 'repos':
+        return next(pages)['totalCount']
+    elif count_type == 'stars': # keep counting past the first 100 repositories
+        return sum(stars_counter(page['edges']) for page in pages)
+
+
+HISTORY_FRAGMENT = '''
+    fragment HistoryPage on CommitHistoryConnection {
+        totalCount
+        edges {
+            node {
+                ... on Commit {
+                    oid
+                    committedDate
+                }
+                author {
+                    user {
+                        id
+                    }
+                }
+                deletions
+                additions
+            }
+        }
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
+    }'''
+
+
+def history_query(anchored):
+    """
+    Returns a GraphQL document that fetches the next page of commits of len(anchored) repositories at once
+    Each repository gets its own alias (r0, r1, ...) and its own $owner, $name, $cursor and $first (page size) variables
+    The first page of a history starts at the default branch. Later pages (anchored[i] is True) page the history of the
+    commit the first page started at ($anchor), so cursors stay valid when commits are pushed mid-scan or before a resume
+    With AUTHOR_FILTER, GitHub filters the history down to my commits, so commits by others are never downloaded
+    """
+    author = ', author: {id: $author_id}' if AUTHOR_FILTER else ''
+    arguments = ', '.join(f'$owner{i}: String!, $name{i}: String!, $cursor{i}: String, $first{i}: Int!' + (f', $anchor{i}: GitObjectID!' if anchor else '')
+                          for i, anchor in enumerate(anchored))
+    if AUTHOR_FILTER:
+        arguments += ', $author_id: ID!'
+    repositories = ''
+    for i, anchor in enumerate(anchored):
+        commit = f'''
+                ... on Commit {{
+                    oid
+                    history(first: $first{i}, after: $cursor{i}{author}) {{
+                        ...HistoryPage
+                    }}
+                }}'''
+        if anchor:
+            commit = f'object(oid: $anchor{i}) {{{commit}\n            }}'
+        else:
+            commit = f'defaultBranchRef {{\n            target {{{commit}\n            }}\n            }}'
+        repositories += f'''
+        r{i}: repository(name: $name{i}, owner: $owner{i}) {{
+            {commit}
+        }}'''
+    return '''
+    query (''' + arguments + ''') {''' + repositories + '''
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
+    }''' + HISTORY_FRAGMENT
 
 
-def recursive_loc(owner, repo_name, data, cache_comment, addition_total=0, deletion_total=0, my_commits=0, cursor=None):
+def batch_loc(states):
     """
-    Uses GitHub's GraphQL v4 API and cursor pagination to fetch 100 commits from a repository at a time
+    Uses GitHub's GraphQL v4 API and cursor pagination to fetch the next page of commits of every repository in states with one request,
+    then hands each repository's page to loc_counter_one_repo
+    Each repository's page size is its own (see page_size), so one with huge diffs doesn't slow down the others' later batches
+    Returns the query cost GitHub reports, which history_worker uses to size the next batch
     """
-    query_count('recursive_loc')
+    query_count('batch_loc')
+    query = history_query([state['anchor'] is not None for state in states])
+    variables = {'author_id': OWNER_ID['id']} if AUTHOR_FILTER else {}
+    for i, state in enumerate(states):
+        variables.update({f'owner{i}': state['owner'], f'name{i}': state['repo_name'], f'cursor{i}': state['cursor'], f'first{i}': page_size(state['hash'])})
+        if state['anchor'] is not None:
+            variables[f'anchor{i}'] = state['anchor']
+    # a gateway error can't be pinned on one repository, so every page in the batch shrinks
+    shrink = lambda variables: {**variables, **{f'first{i}': shrink_page(state['hash']) for i, state in enumerate(states)}}
+    repositories = [f"{state['owner']}/{state['repo_name']}" for state in states]
+    response = simple_request(batch_loc.__name__, query, variables, {'repositories': repositories}, shrink)
+    for state in states:
+        page_timed(state['hash'], response.elapsed.total_seconds())
+    data = response.json()['data']
+    for i, state in enumerate(states):
+        repository = data[f'r{i}']
+        if repository is not None and 'object' in repository:
+            commit = repository['object']
+            if commit is None: # the commit a checkpoint was paging is gone (force-pushed and garbage collected)
+                state['lost'] = state['done'] = True
+                continue
+        else:
+            commit = repository and repository['defaultBranchRef'] and repository['defaultBranchRef']['target']
+        if commit is None: # the repository is empty or gone
+            state['empty'] = state['done'] = True
+        else:
+            state['anchor'] = commit['oid']
+            loc_counter_one_repo(state, commit['history'])
+    return data['rateLimit']['cost']
+
+
+def history_state(repo_hash, edge, row, mark=None):
+    """
+    Returns the pagination state of one repository's history
+    History is returned newest first, so when mark (the newest commit OID already counted) is given, paging stops as soon as it is reached
+    """
+    owner, repo_name = edge['node']['nameWithOwner'].split('/')
+    return {'hash': repo_hash, 'edge': edge, 'row': row, 'owner': owner, 'repo_name': repo_name, 'mark': mark, 'cursor': None, 'anchor': None,
+            'additions': 0, 'deletions': 0, 'my_commits': 0, 'head': None, 'seen': 0, 'found': False, 'count': None,
+            'empty': False, 'done': False, 'author_filter': AUTHOR_FILTER, 'authors': {} if SHARED_STORE else None, 'incremental': False, 'months': {}}
+
+
+def loc_counter_one_repo(state, history):
+    """
+    Adds one page of history (GraphQL can only search up to 100 commits at a time) to the repository's pagination state
+    with count_commit, and stops at the mark if there is one
+    """
+    if state['count'] is None:
+        state['count'] = history['totalCount']
+    for node in history['edges']:
+        if state['head'] is None:
+            state['head'] = node['node']['oid']
+        if node['node']['oid'] == state['mark']:
+            state['found'] = state['done'] = True
+            return
+        count_commit(state, node['node'])
+
+    if history['edges'] == [] or not history['pageInfo']['hasNextPage']:
+        state['done'] = True
+    else:
+        state['cursor'] = history['pageInfo']['endCursor']
+
+
+def count_commit(state, commit):
+    """
+    Adds one commit to the repository's pagination state, only adding the LOC value of commits authored by me
+    My commits are also summed per month of their commit date in state['months'], for the rollups (see merge_rollup)
+    For the shared store, every author's commits and LOC are summed separately in state['authors']
+    """
+    state['seen'] += 1
+    if state['authors'] is not None and commit['author']['user']:
+        sums = state['authors'].setdefault(commit['author']['user']['id'], [0, 0, 0])
+        sums[0] += 1
+        sums[1] += commit['additions']
+        sums[2] += commit['deletions']
+    if OWNER_ID is not None and commit['author']['user'] == OWNER_ID: # the shared store has no "me", see batch_main
+        state['my_commits'] += 1
+        state['additions'] += commit['additions']
+        state['deletions'] += commit['deletions']
+        sums = state['months'].setdefault(str(month_index(commit['committedDate'])), [0, 0, 0])
+        sums[0] += 1
+        sums[1] += commit['additions']
+        sums[2] += commit['deletions']
+
+
+def merged_commits(state):
+    """
+    Counts the new commits of a history again when some of them weren't paged before reaching the mark: commits merged in from
+    a branch that is older than the mark are listed after it. Rather than paging the rest of the history, REST compare lists
+    every commit the paged head has and the row's head doesn't, and their LOC is fetched 100 commits per GraphQL request
+    If the row's head turns out not to be an ancestor of the paged head, the state is left as it is, and finish_repo_loc rescans
+    """
+    repository = f"{state['owner']}/{state['repo_name']}"
+    path = f"/repos/{repository}/compare/{state['row'][4]}...{state['anchor']}"
+    oids, page = [], 1
+    while True:
+        comparison = github_client.rest(merged_commits.__name__, path, {'per_page': 100, 'page': page}, {'repositories': [repository]}).json()
+        if comparison['status'] != 'ahead':
+            return
+        oids += [commit['sha'] for commit in comparison['commits']]
+        if not comparison['commits'] or len(oids) >= comparison['total_commits']:
+            break
+        page += 1
+    print(f"Counting the {len(oids)} new commits of {repository}, some of them merged in below the mark...", flush=True)
+    state['seen'] = state['my_commits'] = state['additions'] = state['deletions'] = 0
+    state['months'] = {}
+    if state['authors'] is not None:
+        state['authors'] = {}
+    for start in range(0, len(oids), 100):
+        for commit in commit_nodes(state, oids[start:start + 100]):
+            if not AUTHOR_FILTER or commit['author']['user'] == OWNER_ID: # the paged history only had my commits
+                count_commit(state, commit)
+
+
+def commit_nodes(state, oids):
+    """
+    Returns the commits oids of the state's repository, with the same fields as in a history page, using one aliased GraphQL request
+    """
+    query_count('merged_commits')
+    arguments = ''.join(f', $oid{i}: GitObjectID!' for i in range(len(oids)))
+    commits = ''.join(f'''
+            c{i}: object(oid: $oid{i}) {{
+                ...CommitStats
+            }}''' for i in range(len(oids)))
     query = '''
-    query ($repo_name: String!, $owner: String!, $cursor: String) {
-        repository(name: $repo_name, owner: $owner) {
-            defaultBranchRef {
-                target {
-                    ... on Commit {
-                        history(first: 100, after: $cursor) {
-                            totalCount
-                            edges {
-                                node {
-                                    ... on Commit {
-                                        committedDate
-                                    }
-                                    author {
-                                        user {
-                                            id
-                                        }
-                                    }
-                                    deletions
-                                    additions
-                                }
-                            }
-                            pageInfo {
-                                endCursor
-                                hasNextPage
-                            }
-                        }
-                    }
-                }
+    query ($owner: String!, $name: String!''' + arguments + ''') {
+        repository(owner: $owner, name: $name) {''' + commits + '''
+        }
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
+    }
+    fragment CommitStats on Commit {
+        oid
+        committedDate
+        author {
+            user {
+                id
             }
         }
+        deletions
+        additions
     }'''
-    variables = {'repo_name': repo_name, 'owner': owner, 'cursor': cursor}
-    time.sleep(1.0)  # Add 1-second delay
-    retry_range = 5
-    for attempt in range(retry_range):  # Retry up to 3 times
-        print(f"Making request in recursive_loc (attempt {attempt + 1}/{retry_range})...", flush=True)
-        request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables':variables}, headers=HEADERS, timeout=20)
-        if request.status_code == 200:
-            if request.json()['data']['repository']['defaultBranchRef'] != None:
-                return loc_counter_one_repo(owner, repo_name, data, cache_comment, request.json()['data']['repository']['defaultBranchRef']['target']['history'], addition_total, deletion_total, my_commits)
+    variables = {'owner': state['owner'], 'name': state['repo_name'], **{f'oid{i}': oid for i, oid in enumerate(oids)}}
+    response = simple_request(merged_commits.__name__, query, variables, {'repositories': [f"{state['owner']}/{state['repo_name']}"]})
+    repository = response.json()['data']['repository']
+    return [repository[f'c{i}'] for i in range(len(oids))]
+
+
+def history_worker(pending, data, cache_comment, stop):
+    """
+    Pages the histories of repositories taken from the pending queue, several repositories per request, until it gets None
+    Repositories whose pagination has finished drop out of the batch and are replaced from the queue. The batch grows
+    while GitHub reports the query cost under QUERY_COST_TARGET, and is halved when it goes over
+    After every page, each unfinished history is recorded in CHECKPOINTS so a later run can resume it
+    Each finished repository is recorded as a telemetry span, from when it joined a batch, with how many pages it took
+    """
+    batch, batch_size, finished = [], max(1, LOC_BATCH_SIZE), False
+    started, pages = {}, {} # repository hash -> when it joined a batch, and how many pages it has taken
+    while not stop.is_set():
+        while len(batch) < batch_size and not finished:
+            try: # only block waiting for repositories when there is nothing to page
+                state = pending.get(block=not batch)
+            except queue.Empty:
+                break
+            if state is None: # cache_builder has gone through every repository
+                finished = True
             else:
-                return 0
-        elif request.status_code in (502, 503, 504):  # Retry on gateway errors
-            print(f"API request in recursive_loc failed with status {request.status_code}, attempt {attempt + 1}/{retry_range}. Retrying after delay...", flush=True)
-            time.sleep(2 ** attempt)  # Exponential backoff
-            continue
-        elif request.status_code == 403:
-            raise Exception('Too many requests in a short amount of time!\nYou\'ve hit the non-documented anti-abuse limit!')
-        else:
-            force_close_file(data, cache_comment)
-            raise Exception('recursive_loc() has failed with a', request.status_code, request.text, QUERY_COUNT)
-    # If all retries fail
-    force_close_file(data, cache_comment)
-    raise Exception('recursive_loc() failed after 3 retries with status', request.status_code, request.text, QUERY_COUNT)
+                batch.append(state)
+                started.setdefault(state['hash'], time.perf_counter())
+        if not batch:
+            return
+        cost = batch_loc(batch)
+        for state in batch:
+            pages[state['hash']] = pages.get(state['hash'], 0) + 1
+        if cost > QUERY_COST_TARGET:
+            batch_size = max(1, batch_size // 2)
+        elif len(batch) == batch_size:
+            batch_size = min(LOC_BATCH_MAX, batch_size + 1)
+        for state in list(batch):
+            if not state['done']:
+                with CHECKPOINT_LOCK:
+                    CHECKPOINTS[state['hash']] = copy.deepcopy(state) # the next page changes state['authors'] and state['months'] in place
+                continue
+            batch.remove(state)
+            row = finish_repo_loc(state)
+            edge = state.get('next_edge', state['edge'])
+            if row is None: # history was rewritten under the mark or the checkpoint, start over from the newest commit
+                with CHECKPOINT_LOCK:
+                    CHECKPOINTS.pop(state['hash'], None)
+                batch.append(history_state(state['hash'], edge, state['row']))
+                continue
+            with CHECKPOINT_LOCK:
+                data[state['hash']] = row
+                if state['authors'] is not None:
+                    merge_authors(state)
+                if not SHARED_STORE:
+                    merge_rollup(state['hash'], state['months'], state['incremental'])
+                CHECKPOINTS.pop(state['hash'], None)
+            if 'next_edge' in state: # resumed from a checkpoint, now catch up with the commits pushed since
+                batch.append(start_repo_loc(state['hash'], edge, row))
+                continue
+            start = started.pop(state['hash'])
+            telemetry.record('repository', 'repository', start, time.perf_counter() - start,
+                             repository=f"{state['owner']}/{state['repo_name']}", pages=pages.pop(state['hash']), commits=state['seen'])
+        checkpoint(data, cache_comment)
+
+
+def month_index(date):
+    """
+    Returns the rollup month of a date like '2024-05-17T...', counted from January of ROLLUP_EPOCH
+    Older dates (e.g. histories imported from SVN, or a bad clock) give negative months
+    """
+    return (int(date[:4]) - ROLLUP_EPOCH) * 12 + int(date[5:7]) - 1
 
 
-def loc_counter_one_repo(owner, repo_name, data, cache_comment, history, addition_total, deletion_total, my_commits):
+def merge_rollup(repo_hash, months, incremental):
     """
-    Recursively call recursive_loc (since GraphQL can only search 100 commits at a time)
-    only adds the LOC value of commits authored by me
+    Records the monthly sums ({month: [commits, LOC added, LOC deleted]}) of a finished history in ROLLUPS,
+    added to the stored ones if only new commits were counted
     """
-    for node in history['edges']:
-        if node['node']['author']['user'] == OWNER_ID:
-            my_commits += 1
-            addition_total += node['node']['additions']
-            deletion_total += node['node']['deletions']
+    if incremental and repo_hash in ROLLUPS:
+        first, *series = ROLLUPS[repo_hash]
+        stored = {str(first + offset): [column[offset] for column in series] for offset in range(len(series[0]))}
+        for month, sums in months.items():
+            stored[month] = [old + new for old, new in zip(stored.get(month, [0, 0, 0]), sums)]
+        months = stored
+    months = {int(month): sums for month, sums in months.items() if sums[0]}
+    if not months:
+        ROLLUPS.pop(repo_hash, None)
+        return
+    first, last = min(months), max(months)
+    ROLLUPS[repo_hash] = [first] + [[months.get(month, [0, 0, 0])[column] for month in range(first, last + 1)] for column in range(3)]
+
+
+def rollup_complete(repo_hash, row):
+    """
+    Returns True if the repository's rollup adds up to its cache row, i.e. every one of my commits is in a month
+    Rows counted before the rollups existed don't, and are counted again once to backfill them
+    """
+    if row[1] == 0:
+        return True
+    if repo_hash not in ROLLUPS:
+        return False
+    return [sum(column) for column in ROLLUPS[repo_hash][1:]] == row[1:4]
 
-    if history['edges'] == [] or not history['pageInfo']['hasNextPage']:
-        return addition_total, deletion_total, my_commits
-    else: return recursive_loc(owner, repo_name, data, cache_comment, addition_total, deletion_total, my_commits, history['pageInfo']['endCursor'])
+
+def rollup_prefix_sums(data):
+    """
+    Returns the first month of the totals, and the running totals of my commits, LOC added and LOC deleted per month from it,
+    over every repository in the cache dict. The first month is the oldest of any rollup, or ROLLUP_EPOCH's January if none is older
+    Element m of each list is the total of the months before first + m, so the total of any range of months is one subtraction
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rollups = [ROLLUPS[repo_hash] for repo_hash, row in data.items() if row[1] and repo_hash in ROLLUPS]
+    base = min([0] + [rollup[0] for rollup in rollups])
+    months = max([month_index(now.isoformat()) + 1] + [rollup[0] + len(rollup[1]) for rollup in rollups]) - base
+    totals = [[0] * months for _ in range(3)]
+    for first, *series in rollups:
+        for column in range(3):
+            for offset, value in enumerate(series[column]):
+                totals[column][first - base + offset] += value
+    return base, [list(itertools.accumulate(column, initial=0)) for column in totals]
+
+
+def loc_windows(data):
+    """
+    Returns my commits and LOC over recent windows of time, from the monthly rollups of the repositories in the cache dict,
+    without any request to GitHub
+    """
+    base, prefix = rollup_prefix_sums(data)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    this_month = month_index(now.isoformat())
+    window = lambda start, end: [column[end - base] - column[max(0, start - base)] for column in prefix] # months start to end - 1
+    commits, additions, deletions = window(this_month - now.month + 1, this_month + 1)
+    return {
+        'loc_this_year': ['{:,}'.format(additions), '{:,}'.format(deletions), '{:,}'.format(additions - deletions)],
+        'commits_this_year': commits,
+        'commits_last_12_months': window(this_month - 11, this_month + 1)[0],
+        'commits_this_month': window(this_month, this_month + 1)[0],
+    }
 
 
-def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None, edges=[]):
+def merge_authors(state):
     """
-    Uses GitHub's GraphQL v4 API to query all the repositories I have access to (with respect to owner_affiliation)
-    Queries 60 repos at a time, because larger queries give a 502 timeout error and smaller queries send too many
-    requests and also give a 502 error.
-    Returns the total number of lines of code in all repositories
+    Records the per-author sums of a finished history in AUTHORS, added to the stored ones if only new commits were paged
+    """
+    if state['incremental']:
+        sums = {author: list(counts) for author, counts in AUTHORS.get(state['hash'], {}).items()}
+        for author, counts in state['authors'].items():
+            sums[author] = [old + new for old, new in zip(sums.get(author, [0, 0, 0]), counts)]
+        AUTHORS[state['hash']] = sums
+    else:
+        AUTHORS[state['hash']] = state['authors']
+
+
+def git(*args, stdin=None):
+    """
+    Runs a git command and returns its output, or raises an Exception with git's error message if it fails
+    Clones and fetches from GitHub are authenticated with the access token, passed as a header rather than stored in the mirror.
+    The header goes through git's environment config, since its command line can be read by any process on the machine
+    """
+    env = None
+    if 'github.com' in GIT_REMOTE_URL and ('clone' in args or 'fetch' in args):
+        token = base64.b64encode(f"x-access-token:{os.environ['ACCESS_TOKEN']}".encode('utf-8')).decode('ascii')
+        env = {**os.environ, 'GIT_CONFIG_COUNT': '1', 'GIT_CONFIG_KEY_0': 'http.https://github.com/.extraheader',
+               'GIT_CONFIG_VALUE_0': f'Authorization: Basic {token}'}
+    result = subprocess.run(['git'] + list(args), input=stdin, capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise Exception('git ' + ' '.join(args[:3]) + ' failed:', result.stderr.strip())
+    return result.stdout
+
+
+def update_mirror(name, head):
+    """
+    Returns the path of the blobless bare mirror of a repository, cloning it or fetching its default branch if head is missing
+    Blobs are only downloaded by git log when it needs them to diff one of my commits, and are kept for the next run
+    """
+    path = os.path.join(GIT_MIRROR_DIR, name + '.git')
+    if not os.path.exists(path):
+        print(f"Cloning {name}...", flush=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        git('clone', '--bare', '--single-branch', '--filter=blob:none', GIT_REMOTE_URL.format(name=name), path)
+    if subprocess.run(['git', '-C', path, 'cat-file', '-e', head + '^{commit}'], capture_output=True).returncode != 0:
+        print(f"Fetching {name}...", flush=True)
+        git('-C', path, 'fetch', '--filter=blob:none', 'origin', '+HEAD:refs/heads/mirror-head')
+    return path
+
+
+def git_author_options():
+    """
+    Returns the git log options that keep only my commits, by GIT_AUTHOR_EMAILS or my GitHub noreply address
+    """
+    escape = lambda text: re.sub(r'([.^$*+?()\[\]{}|\\])', r'\\\1', text) # POSIX extended regular expression
+    emails = [escape(email) for email in GIT_AUTHOR_EMAILS] + [r'([0-9]+\+)?' + escape(USER_NAME) + r'@users\.noreply\.github\.com']
+    return ['--no-renames', '--diff-merges=first-parent', '--extended-regexp', '--regexp-ignore-case', '--author=<(' + '|'.join(emails) + ')>']
+
+
+def prefetch_blobs(path, revisions):
+    """
+    Downloads the blobs my commits in revisions changed in one fetch, instead of git log fetching them lazily one diff at a time
+    Listing them with --raw only compares trees, which the blobless mirror already has
+    """
+    output = git('-C', path, 'log', revisions, '--format=', '--raw', '--no-abbrev', *git_author_options())
+    blobs = {oid for line in output.splitlines() if line.startswith(':') for oid in line.split()[2:4]} - {'0' * 40}
+    if blobs:
+        git('-C', path, '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', '--quiet', '--no-tags', '--no-write-fetch-head',
+            '--recurse-submodules=no', '--filter=blob:none', '--stdin', 'origin', stdin='\n'.join(sorted(blobs)) + '\n')
+
+
+def git_numstat(path, revisions):
+    """
+    Returns my commit count, additions, deletions, newest commit and monthly sums in revisions (e.g. 'head' or 'old..head'),
+    using git log --numstat. Merge commits are diffed against their first parent, and binary files count as no lines
+    """
+    prefetch_blobs(path, revisions)
+    output = git('-C', path, 'log', revisions, '--format=%x00%H %ct', '--numstat', *git_author_options())
+    my_commits, additions, deletions, newest, months = 0, 0, 0, None, {}
+    for commit in output.split('\0')[1:]:
+        lines = commit.split('\n')
+        oid, committed = lines[0].split(' ')
+        newest = newest or oid
+        sums = months.setdefault(str(month_index(time.strftime('%Y-%m', time.gmtime(int(committed))))), [0, 0, 0])
+        my_commits += 1
+        sums[0] += 1
+        for line in lines[1:]:
+            if line:
+                added, deleted, _ = line.split('\t', 2)
+                added, deleted = int(added) if added != '-' else 0, int(deleted) if deleted != '-' else 0
+                additions, deletions, sums[1], sums[2] = additions + added, deletions + deleted, sums[1] + added, sums[2] + deleted
+    return my_commits, additions, deletions, newest, months
+
+
+def git_repo_loc(edge, row):
+    """
+    Returns the updated cache row of a repository, counted in its local mirror instead of through the API, with the monthly sums
+    of the commits counted and whether they were only the new ones
+    If the commit the row was counted up to is still in the history, only the commits after it are counted and added,
+    otherwise (e.g. after a force-push) the whole history is counted again. The row has the same layout as finish_repo_loc's
+    """
+    target = edge['node']['defaultBranchRef']['target']
+    head = target['oid']
+    path = update_mirror(edge['node']['nameWithOwner'], head)
+    commit_count, my_commits, loc_add, loc_del, old_head, my_mark = row
+    incremental = bool(old_head) and subprocess.run(['git', '-C', path, 'merge-base', '--is-ancestor', old_head, head], capture_output=True).returncode == 0
+    if incremental:
+        new_commits, additions, deletions, newest, months = git_numstat(path, f'{old_head}..{head}')
+        my_commits, loc_add, loc_del, newest = my_commits + new_commits, loc_add + additions, loc_del + deletions, newest or my_mark
+    else:
+        my_commits, loc_add, loc_del, newest, months = git_numstat(path, head)
+    return [target['history']['totalCount'], my_commits, loc_add, loc_del, head, newest if AUTHOR_FILTER else None], months, incremental
+
+
+def git_worker(pending, data, cache_comment, stop):
+    """
+    Counts the repositories taken from the pending queue in their local mirrors with git_repo_loc, until it gets None
+    The LOC_WORKERS workers each run their own git processes, so repositories are counted in parallel
+    """
+    while not stop.is_set():
+        state = pending.get()
+        if state is None: # cache_builder has gone through every repository
+            return
+        edge = state.get('next_edge', state['edge'])
+        with telemetry.span('repository', 'repository', repository=edge['node']['nameWithOwner'], engine='git'):
+            row, months, incremental = git_repo_loc(edge, state['row'])
+        with CHECKPOINT_LOCK:
+            data[state['hash']] = row
+            merge_rollup(state['hash'], months, incremental)
+            CHECKPOINTS.pop(state['hash'], None)
+        checkpoint(data, cache_comment)
+
+
+def repository_pages(owner_affiliation):
+    """
+    Yields the pages of USER_NAME's repositories (with respect to owner_affiliation), most recently pushed first,
+    with each repository's default branch head and commit count
+    Starts at 60 repos at a time, because larger queries can give a 502 timeout error and smaller queries send too many
+    requests. The page size then adapts to how GitHub actually responds, see page_size
     """
-    query_count('loc_query')
     query = '''
-    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
+    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String, $first: Int!) {
         user(login: $login) {
-            repositories(first: 60, after: $cursor, ownerAffiliations: $owner_affiliation) {
+            repositories(first: $first, after: $cursor, ownerAffiliations: $owner_affiliation, orderBy: {field: PUSHED_AT, direction: DESC}) {
             edges {
                 node {
                     ... on Repository {
                         nameWithOwner
+                        pushedAt
                         defaultBranchRef {
                             target {
                                 ... on Commit {
+                                    oid
                                     history {
                                         totalCount
                                         }
@@ -240,99 +817,364 @@ def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None,
                 }
             }
         }
+        rateLimit {
+            cost
+            remaining
+            resetAt
+        }
     }'''
-    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(loc_query.__name__, query, variables)
-    if request.json()['data']['user']['repositories']['pageInfo']['hasNextPage']:   # If repository data has another page
-        edges += request.json()['data']['user']['repositories']['edges']            # Add on to the LoC count
-        return loc_query(owner_affiliation, comment_size, force_cache, request.json()['data']['user']['repositories']['pageInfo']['endCursor'], edges)
-    else:
-        return cache_builder(edges + request.json()['data']['user']['repositories']['edges'], comment_size, force_cache)
+    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': None}
+    return paginate(loc_query.__name__, query, variables, lambda data: data['user']['repositories'])
+
+
+def loc_query(owner_affiliation, comment_size=0, force_cache=False):
+    """
+    Uses GitHub's GraphQL v4 API to query all the repositories I have access to (with respect to owner_affiliation)
+    Returns the total number of lines of code in all repositories
+    Repositories are streamed into cache_builder page by page, so their histories start updating before the last page arrives
+    Repositories come most recently pushed first. Unless a full scan is due, paging stops at the first page that reaches
+    repositories not pushed since the last run, and every older repository keeps its cached row
+    """
+    discovery = load_discovery()
+    full_scan = force_cache or full_scan_due(discovery)
+    pages = repository_pages(owner_affiliation)
+    pushed = [discovery.get('pushed_since') or '']
+    edges = discover_edges(pages, None if full_scan else pushed[0], pushed)
+    total_loc = cache_builder(edges, comment_size, force_cache, prune=full_scan)
+    if full_scan:
+        discovery['full_scan'] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    discovery['pushed_since'] = pushed[0]
+    write_file_atomic(discovery_file_name(), json.dumps(discovery, indent=1, sort_keys=True))
+    return total_loc
+
+
+def full_scan_due(discovery):
+    """
+    Returns True if this run has to page every repository: when FULL_SCAN is set, on the first run, without a cache file,
+    or when the last full scan is more than FULL_SCAN_DAYS old
+    Full scans catch what pushedAt doesn't show, like a repository I was just given access to or one I lost access to
+    """
+    if FULL_SCAN or not discovery.get('full_scan') or not os.path.exists(cache_file_name()):
+        return True
+    last = datetime.datetime.fromisoformat(discovery['full_scan'])
+    return datetime.datetime.now(datetime.timezone.utc) - last > datetime.timedelta(days=FULL_SCAN_DAYS)
+
+
+def discover_edges(pages, pushed_since, pushed):
+    """
+    Yields the repository edges of pages, which come most recently pushed first
+    With pushed_since (a pushedAt from the last run), stops after the first page that ends with a repository pushed before it
+    pushed[0] is raised to the newest pushedAt seen, which becomes pushed_since for the next run.
+    GitHub's own timestamps are compared, so the runner's clock doesn't matter
+    """
+    for page_number, page in enumerate(pages, 1):
+        for edge in page['edges']:
+            pushed[0] = max(pushed[0], edge['node']['pushedAt'] or '')
+            yield edge
+        if pushed_since is not None and page['edges'] and (page['edges'][-1]['node']['pushedAt'] or '') < pushed_since:
+            print(f"Found every repository pushed since {pushed_since} in {page_number} page(s), the rest are cached", flush=True)
+            return
 
 
-def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0):
+def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0, prune=True):
     """
-    Checks each repository in edges to see if it has been updated since the last time it was cached
-    If it has, run recursive_loc on that repository to update the LOC count
+    Checks each repository in edges (any iterable, consumed as it arrives) to see if it has been updated since the last time it was cached
+    If it has, page that repository's history again to update the LOC count
+    The cache is keyed by repository hash, so gaining, losing or reordering repositories only touches those entries
+    With prune, edges is every repository I have access to, and cached repositories missing from it are dropped
     """
     cached = True # Assume all repositories are cached
-    filename = 'cache/'+get_hash_file_name()+'.txt' # Create a unique filename for each user
+    cache_comment, data = load_cache(comment_size)
+    if force_cache:
+        cached = False
+        flush_cache(data)
+
+    # if commit count has changed, update loc for that repo. LOC_WORKERS workers page the stale repositories in batches
+    # while edges are still arriving, and each result is written back under its own hash, so the cache file is identical to a serial run
+    pending, stop, seen = queue.Queue(), threading.Event(), set()
+    workers = max(1, LOC_WORKERS)
+    worker = git_worker if LOC_ENGINE == 'git' else history_worker
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker, pending, data, cache_comment, stop) for _ in range(workers)]
+        try:
+            try:
+                for edge in edges:
+                    if any(future.done() for future in futures): # a worker has failed, stop reading repositories
+                        break
+                    if SHUTDOWN.is_set():
+                        raise SystemExit('Terminated')
+                    repo_hash = hashlib.sha256(edge['node']['nameWithOwner'].encode('utf-8')).hexdigest()
+                    seen.add(repo_hash)
+                    if repo_hash not in data: # new repository, count it from scratch
+                        cached = False
+                        with CHECKPOINT_LOCK: # the workers' checkpoints iterate over data
+                            data[repo_hash] = [0, 0, 0, 0, None, None]
+                    try:
+                        target = edge['node']['defaultBranchRef']['target']
+                        if not SHARED_STORE and not rollup_complete(repo_hash, data[repo_hash]): # counted before the rollups, count it again from scratch
+                            pending.put(start_repo_loc(repo_hash, edge, [0, 0, 0, 0, None, None]))
+                        elif data[repo_hash][0] != target['history']['totalCount'] or (data[repo_hash][4] and data[repo_hash][4] != target['oid']):
+                            pending.put(start_repo_loc(repo_hash, edge, data[repo_hash]))
+                    except TypeError: # If the repo is empty
+                        with CHECKPOINT_LOCK:
+                            data[repo_hash] = [0, 0, 0, 0, None, None]
+            finally:
+                for _ in futures: # tell every worker there are no more repositories coming
+                    pending.put(None)
+            while wait(futures, timeout=1, return_when=FIRST_EXCEPTION).not_done:
+                if SHUTDOWN.is_set(): # interrupted while running in a stage thread, which signals can't reach
+                    raise SystemExit('Terminated')
+            for future in futures:
+                future.result()
+        except BaseException: # including an interrupt or SIGTERM, e.g. when the workflow times out
+            stop.set()
+            pool.shutdown(wait=True)
+            force_close_file(data, cache_comment)
+            raise
+    for repo_hash in list(data):
+        if prune and repo_hash not in seen: # I no longer have access to this repository
+            del data[repo_hash]
+    CHECKPOINTS.clear() # every history has finished, nothing is left to resume
+    checkpoint(data, cache_comment, force=True)
+    __, __, loc_add, loc_del = cache_totals(data)
+    return [loc_add, loc_del, loc_add - loc_del, cached]
+
+
+def start_repo_loc(repo_hash, edge, row):
+    """
+    Returns the pagination state that brings one repository's cache row up to date
+    If a previous run stopped partway through this repository, its checkpoint is resumed from the saved cursor and sums.
+    If the row has a high-water mark (the newest commit OID already counted), only the commits newer than it are fetched
+    """
+    resumed = CHECKPOINTS.get(repo_hash)
+    if resumed and resumed['row'] == row and resumed['author_filter'] == AUTHOR_FILTER:
+        print(f"Resuming {resumed['owner']}/{resumed['repo_name']} from its checkpoint...", flush=True)
+        state = {'months': {}, **copy.deepcopy(resumed)} # checkpoints from before the rollups lack months
+        if state['edge'] != edge: # the resumed history stops at the commit it started from, catch up afterwards
+            state['next_edge'] = edge
+        return state
+    total = edge['node']['defaultBranchRef']['target']['history']['totalCount']
+    mark = row[5] if AUTHOR_FILTER else row[4]
+    return history_state(repo_hash, edge, row, mark if total >= row[0] else None)
+
+
+def finish_repo_loc(state):
+    """
+    Returns the updated cache row of a repository whose history has been paged, or None if it has to be paged again from the start
+    New commits are added to the stored totals. The whole history is only rescanned when it was rewritten (e.g. by a force-push),
+    which shows up as the mark missing from the history or as a number of new commits that doesn't match totalCount.
+    When the mark is found with too few new commits before it, the rest were merged in below it, and are found by merged_commits
+    The row is made from the history that was actually paged (its totalCount and the commit it started at), not from the listing,
+    which is older if commits were pushed in between
+    With AUTHOR_FILTER the history only has my commits, so the mark is my newest commit, and its totalCount is my commit count
+    """
+    if state['empty']:
+        return [0, 0, 0, 0, None, None]
+    if state.get('lost'):
+        print(f"The commit {state['owner']}/{state['repo_name']} was resumed from is gone, rescanning...", flush=True)
+        return None
+    commit_count, my_commits, loc_add, loc_del, __, my_mark = state['row']
+    total = state['edge']['node']['defaultBranchRef']['target']['history']['totalCount']
+    if state['found'] and state['row'][4] and state['seen'] < state['count'] - (my_commits if AUTHOR_FILTER else commit_count):
+        merged_commits(state)
+    if AUTHOR_FILTER:
+        if state['found'] and my_commits + state['seen'] == state['count']:
+            state['incremental'] = True
+            return [total, my_commits + state['my_commits'], loc_add + state['additions'], loc_del + state['deletions'], state['anchor'], state['head'] or my_mark]
+    elif state['found'] and state['seen'] == state['count'] - commit_count: # only new commits were fetched, add them to the stored totals
+        state['incremental'] = True
+        return [state['count'], my_commits + state['my_commits'], loc_add + state['additions'], loc_del + state['deletions'], state['head'], None]
+    if state['mark']:
+        print(f"History of {state['owner']}/{state['repo_name']} was rewritten, rescanning...", flush=True)
+        if state['found']: # the mark is still there, but isn't an ancestor of the head any more
+            return None
+        # otherwise the whole history has already been paged through looking for the mark
+    if AUTHOR_FILTER:
+        return [total, state['my_commits'], state['additions'], state['deletions'], state['anchor'], state['head']]
+    return [state['count'], state['my_commits'], state['additions'], state['deletions'], state['head'], None]
+
+
+def cache_file_name():
+    return 'cache/'+get_hash_file_name()+'.txt' # Create a unique filename for each user
+
+
+def contributions_file_name():
+    return 'cache/'+get_hash_file_name()+'.contributions.json'
+
+
+def rollups_file_name():
+    return 'cache/'+get_hash_file_name()+'.rollups.json'
+
+
+def authors_file_name():
+    return 'cache/'+get_hash_file_name()+'.authors.json'
+
+
+def checkpoint_file_name():
+    return 'cache/'+get_hash_file_name()+'.checkpoint.json'
+
+
+def page_size_file_name():
+    return 'cache/'+get_hash_file_name()+'.pages.json'
+
+
+def discovery_file_name():
+    return 'cache/'+get_hash_file_name()+'.discovery.json'
+
+
+def load_discovery():
+    """
+    Returns what loc_query recorded after its last successful run: the newest pushedAt it saw and when it last did a full scan
+    """
+    try:
+        with open(discovery_file_name(), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_file_atomic(filename, content):
+    """
+    Writes content (text or bytes) to filename through a temporary file in the same directory and a rename,
+    so a crash or kill mid-write leaves either the old file or the new one, never half of it
+    If the file already has the same content (by SHA-256) it isn't touched, so unchanged outputs don't show up as changes
+    in the workflow's commit. Returns True if the file was written
+    The file keeps its mode, and a new file gets the mode open() would give it rather than the temporary file's 0600
+    """
+    content = content.encode('utf-8') if isinstance(content, str) else content
+    mode = 0o666 & ~UMASK
+    try:
+        with open(filename, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest():
+                return False
+            mode = os.fstat(f.fileno()).st_mode & 0o7777
+    except FileNotFoundError:
+        pass
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(filename) or '.', prefix='.tmp-', delete=False) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(f.name, mode)
+    os.replace(f.name, filename)
+    return True
+
+
+def load_cache(comment_size):
+    """
+    Reads the cache file into a dict of repository hash -> [total commits, my commits, LOC added, LOC deleted, newest commit OID, my newest commit OID]
+    Returns the comment block and the dict. If the cache file doesn't exist, it is created with an empty comment block
+    Also loads the checkpoints of histories a previous run didn't finish into CHECKPOINTS
+    """
+    filename = cache_file_name()
     try:
         with open(filename, 'r') as f:
-            data = f.readlines()
+            lines = f.readlines()
     except FileNotFoundError: # If the cache file doesn't exist, create it
-        data = []
-        if comment_size > 0:
-            for _ in range(comment_size): data.append('This line is a comment block. Write whatever you want here.\n')
-        with open(filename, 'w') as f:
-            f.writelines(data)
+        lines = ['This line is a comment block. Write whatever you want here.\n'] * comment_size
+        write_file_atomic(filename, ''.join(lines))
+    data = {}
+    for line in lines[comment_size:]:
+        repo_hash, commit_count, my_commits, loc_add, loc_del, *marks = line.split()
+        marks += [None, None]
+        data[repo_hash] = [int(commit_count), int(my_commits), int(loc_add), int(loc_del), marks[0], marks[1]]
+    global CACHE
+    CACHE = data
+    try:
+        with open(checkpoint_file_name(), 'r') as f:
+            CHECKPOINTS.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    if SHARED_STORE:
+        try:
+            with open(authors_file_name(), 'r') as f:
+                AUTHORS.update(json.load(f))
+        except FileNotFoundError:
+            pass
+    else:
+        try:
+            with open(rollups_file_name(), 'r') as f:
+                ROLLUPS.update(json.load(f))
+        except FileNotFoundError:
+            pass
+    return lines[:comment_size], data
 
-    if len(data)-comment_size != len(edges) or force_cache: # If the number of repos has changed, or force_cache is True
-        cached = False
-        flush_cache(edges, filename, comment_size)
-        with open(filename, 'r') as f:
-            data = f.readlines()
 
-    cache_comment = data[:comment_size] # save the comment block
-    data = data[comment_size:] # remove those lines
+def write_cache(data, cache_comment):
+    """
+    Writes the cache dict back to the cache file, sorted by repository hash so the order GitHub lists repositories in doesn't matter
+    """
+    lines = list(cache_comment)
+    for repo_hash in sorted(data):
+        commit_count, my_commits, loc_add, loc_del, mark, my_mark = data[repo_hash]
+        lines.append(f"{repo_hash} {commit_count} {my_commits} {loc_add} {loc_del}" + (f" {mark}" if mark else '') + (f" {my_mark}" if mark and my_mark else '') + '\n')
+    write_file_atomic(cache_file_name(), ''.join(lines))
 
-    # Verify data length matches len(edges)
-    if len(data) != len(edges):
-        print(f"Cache file mismatch: expected {len(edges)} entries, found {len(data)}. Reinitializing cache...", flush=True)
-        flush_cache(edges, filename, comment_size)
-        time.sleep(0.1)
-        with open(filename, 'r') as f:
-            data = f.readlines()
-        cache_comment = data[:comment_size]
-        data = data[comment_size:]
 
-    for index in range(len(edges)):
-        repo_hash, commit_count, *__ = data[index].split()
-        if repo_hash == hashlib.sha256(edges[index]['node']['nameWithOwner'].encode('utf-8')).hexdigest():
-            try:
-                if int(commit_count) != edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']:
-                    # if commit count has changed, update loc for that repo
-                    owner, repo_name = edges[index]['node']['nameWithOwner'].split('/')
-                    loc = recursive_loc(owner, repo_name, data, cache_comment)
-                    data[index] = repo_hash + ' ' + str(edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']) + ' ' + str(loc[2]) + ' ' + str(loc[0]) + ' ' + str(loc[1]) + '\n'
-            except TypeError: # If the repo is empty
-                data[index] = repo_hash + ' 0 0 0 0\n'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
-    for line in data:
-        loc = line.split()
-        loc_add += int(loc[3])
-        loc_del += int(loc[4])
-    return [loc_add, loc_del, loc_add - loc_del, cached]
+def checkpoint(data, cache_comment, force=False):
+    """
+    Saves the cache and the checkpoints of unfinished histories, at most once every CHECKPOINT_INTERVAL seconds unless forced
+    The cache is written first: a repository's checkpoint is only used while its cache row is still the one it started from,
+    so a kill between the two writes can't count any commits twice
+    """
+    global LAST_CHECKPOINT
+    with CHECKPOINT_LOCK:
+        if not force and time.monotonic() - LAST_CHECKPOINT < CHECKPOINT_INTERVAL:
+            return
+        LAST_CHECKPOINT = time.monotonic()
+        write_cache(data, cache_comment)
+        write_file_atomic(checkpoint_file_name(), json.dumps(CHECKPOINTS, indent=1, sort_keys=True))
+        if SHARED_STORE:
+            write_file_atomic(authors_file_name(), json.dumps({repo_hash: AUTHORS[repo_hash] for repo_hash in data if repo_hash in AUTHORS},
+                                                              sort_keys=True, separators=(',', ':')))
+        else:
+            write_file_atomic(rollups_file_name(), json.dumps({repo_hash: ROLLUPS[repo_hash] for repo_hash in data if repo_hash in ROLLUPS and data[repo_hash][1]},
+                                                              sort_keys=True, separators=(',', ':')))
+        write_page_sizes(data)
+
+
+def write_page_sizes(data):
+    """
+    Saves the learned page sizes that differ from the defaults, dropping those of repositories no longer in the cache
+    """
+    with PAGE_SIZE_LOCK:
+        if PAGE_SIZES is None: # never loaded, so nothing was learned either
+            return
+        sizes = {key: size for key, size in PAGE_SIZES.items()
+                 if (key in PAGE_SIZE_DEFAULTS or key in data) and size != PAGE_SIZE_DEFAULTS.get(key, PAGE_SIZE_DEFAULTS['history'])}
+    write_file_atomic(page_size_file_name(), json.dumps(sizes, indent=1, sort_keys=True))
+
+
+def cache_totals(data):
+    """
+    Returns [total commits, my commits, LOC added, LOC deleted] summed over every repository in the cache dict
+    """
+    totals = [0, 0, 0, 0]
+    for row in data.values():
+        for column in range(4):
+            totals[column] += row[column]
+    return totals
 
 
-def flush_cache(edges, filename, comment_size):
+def flush_cache(data):
     """
-    Wipes the cache file
-    This is called when the number of repositories changes or when the file is first created
+    Wipes every entry of the cache, so every repository is recounted from scratch
+    This is called when force_cache is True
     """
-    print(f"Starting flush_cache for {len(edges)} repositories...", flush=True)
-    with open(filename, 'r') as f:
-        data = []
-        if comment_size > 0:
-            data = f.readlines()[:comment_size] # only save the comment
-    with open(filename, 'w') as f:
-        f.writelines(data)
-        for node in edges:
-            f.write(hashlib.sha256(node['node']['nameWithOwner'].encode('utf-8')).hexdigest() + ' 0 0 0 0\n')
-    print(f"Cache file flushed with {len(edges)} entries", flush=True)
+    print(f"Starting flush_cache for {len(data)} repositories...", flush=True)
+    for repo_hash in data:
+        data[repo_hash] = [0, 0, 0, 0, None, None]
+    CHECKPOINTS.clear()
+    ROLLUPS.clear()
+    print(f"Cache flushed with {len(data)} entries", flush=True)
 
 def force_close_file(data, cache_comment):
     """
     Forces the file to close, preserving whatever data was written to it
     This is needed because if this function is called, the program would've crashed before the file is properly saved and closed
     """
-    filename = 'cache/'+get_hash_file_name()+'.txt'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
-    print('There was an error while writing to the cache file. The file,', filename, 'has had the partial data saved and closed.')
+    checkpoint(data, cache_comment, force=True)
+    print('There was an error while writing to the cache file. The file,', cache_file_name(), 'has had the partial data saved and closed.')
+    print(f'{len(CHECKPOINTS)} unfinished repositories were checkpointed and will resume from where they stopped.')
 
 
 def stars_counter(data):
@@ -343,101 +1185,306 @@ def stars_counter(data):
     for node in data: total_stars += node['node']['stargazers']['totalCount']
     return total_stars
 
-def extract_html_for_ascii(html):
-    avatar_rows = [[]]
-    root = etree.HTML("<pre>" + html + "</pre>")
-
-    children = root.cssselect('pre > *')  # <span> (line wrappers) + <br/>
-    color_re = re.compile(r'color:\s*(#[0-9a-fA-F]{3,6})')
-    row_pos = 0
-
-    for child in children:
-        if child.tag == 'br':
-            # Start a new row
-            row_pos += 1
-            avatar_rows.append([])
-        elif child.tag == 'span':
-            # Iterate over inner spans (the colored characters)
-            for span in child.cssselect('span'):
-                style = span.get('style', '')
-                color_match = color_re.search(style)
-                color = color_match.group(1) if color_match else "#000000"
-                text = span.text or ""
-                avatar_rows[row_pos].append((text, color))
-
-    return avatar_rows
-
-
-def draw_avatar_color_ascii(root, ascii):
+def avatar_fragment(grid):
+    """
+    Builds the avatar rows from the character/color grid of render_ascii_grid, cropped to ASCII_PRINT_COLS x ASCII_MAX_LINES
+    Returns the rows as children of a detached element, and the CSS for their color classes, or None if there is no grid
+    """
+    from lxml import etree
+    if grid is None:
+        return None
     start_x = 15
     start_y = 30
     line_height = 20
     un_pad = int((ASCII_GEN_COLS-ASCII_PRINT_COLS)/2)
 
-    avatar_rows = extract_html_for_ascii(ascii)
-    total_lines = len(avatar_rows)
+    total_lines = len(grid['chars'])
     total_line_offset = 0 if total_lines <= ASCII_MAX_LINES else int((total_lines-ASCII_MAX_LINES) /2)
     start_row = 0 if total_lines <= ASCII_MAX_LINES else total_line_offset + 1
+    end_row = min(total_lines, start_row + ASCII_MAX_LINES)
+
+    avatar = etree.Element("text")
+    rows = [(grid['chars'][row], grid['colors'][row]) for row in range(start_row, end_row)]
+    rows = [(chars[un_pad:len(chars)-un_pad], colors[un_pad:len(colors)-un_pad]) for chars, colors in rows]
+    palette = avatar_palette([color for chars, colors in rows for char, color in zip(chars, colors) if char != ' '], AVATAR_COLOR_TOLERANCE)
+    classes = {} # palette color -> CSS class, in order of first use
+    for row_idx, (chars, colors) in enumerate(rows):
+        x_pos = start_x
+        text_elem = etree.SubElement(avatar, "tspan", x=str(x_pos), y=str(start_y+(row_idx*line_height)))
+        for text, color in merge_color_runs(chars, [palette.get(color) for color in colors]):
+            tspan = etree.SubElement(text_elem, "tspan")
+            if color is not None:
+                tspan.set('class', classes.setdefault(color, f'av{len(classes)}'))
+            tspan.text = text.replace(' ', '\u00A0')  # Use non-breaking space for spaces
 
-    avatar = root.find(f".//*[@id='avatar']")
+    # One shared rule per color instead of an inline style on every span
+    return avatar, ''.join(f'.{name} {{fill: {color};}}' for color, name in classes.items())
+
+
+def draw_avatar_color_ascii(index, fragment):
+    """
+    Replaces the avatar in an SVG with a copy of the rows from avatar_fragment, and puts their CSS in an avatar_style element
+    If there is no fragment (the avatar couldn't be downloaded), the avatar is left empty
+    """
+    from lxml import etree
+    avatar = index['avatar']
     # Clear any existing content
-    for child in avatar:
+    for child in list(avatar):
         avatar.remove(child)
+    if fragment is None:
+        return
+    rows, css = fragment
+    for row in rows:
+        avatar.append(copy.deepcopy(row))
 
-    for row_idx, row in enumerate(avatar_rows[start_row:-total_line_offset]):
-        x_pos = start_x
-        text_elem = etree.SubElement(avatar, "tspan", x=str(x_pos), y=str(start_y+(row_idx*line_height)))
-        for text, color in row[un_pad:-un_pad]:
-            tspan = etree.SubElement(text_elem, "tspan", style=f'fill: {color};')
-            tspan.text = text if text != ' ' else '\u00A0'  # Use non-breaking space for spaces
+    if 'avatar_style' not in index:
+        index['avatar_style'] = etree.Element("style", id='avatar_style')
+        avatar.addprevious(index['avatar_style'])
+    index['avatar_style'].text = css
 
-def generate_avatar_ascii(avatar_url):
-    # Download the avatar image
-    response = requests.get(avatar_url, timeout=10)
+
+def hex_to_lab(colors):
+    """
+    Converts '#rrggbb' colors to CIELAB (D65), where the distance between two colors matches how different they look
+    """
+    import numpy as np
+    rgb = np.array([[int(color[i:i+2], 16) for i in (1, 3, 5)] for color in colors], dtype=np.float64).reshape(-1, 3) / 255
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ np.array([[0.4124, 0.3576, 0.1805], [0.2126, 0.7152, 0.0722], [0.0193, 0.1192, 0.9505]]).T
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def avatar_palette(colors, tolerance=0):
+    """
+    Maps every color to a palette color within tolerance (CIE76 delta E, 0 means identical) of it
+    Colors are taken most common first, and each one joins the nearest palette color if that is close enough,
+    otherwise it becomes a palette color itself. No character's color moves by more than tolerance
+    """
+    unique = [color for color, _ in Counter(colors).most_common()]
+    if not tolerance:
+        return {color: color for color in unique}
+    lab = hex_to_lab(unique)
+    palette = [] # indices into unique
+    mapping = {}
+    for idx, color in enumerate(unique):
+        if palette:
+            distances = ((lab[palette] - lab[idx]) ** 2).sum(axis=1)
+            nearest = int(distances.argmin())
+            if distances[nearest] <= tolerance ** 2:
+                mapping[color] = unique[palette[nearest]]
+                continue
+        palette.append(idx)
+        mapping[color] = color
+    return mapping
+
+
+def merge_color_runs(chars, colors):
+    """
+    Splits a row of the avatar into runs of neighbouring characters with the same color
+    Spaces draw nothing, so they join any run, and a run of only spaces gets no color (None)
+    Returns a list of (text, color)
+    """
+    runs = []
+    for char, color in zip(chars, colors):
+        if runs and (char == ' ' or runs[-1][1] in (None, color)):
+            runs[-1][0] += char
+            if char != ' ':
+                runs[-1][1] = color
+        else:
+            runs.append([char, None if char == ' ' else color])
+    return [(text, color) for text, color in runs]
+
+
+def download_avatar(avatar_url):
+    """
+    Returns the sha256 of the avatar image, and its bytes if they had to be downloaded
+    The ETag of the last download is sent along, so an unchanged avatar comes back as an empty 304
+    If the download fails, the hash of the last avatar that was downloaded is returned
+    """
+    index_path = os.path.join(AVATAR_CACHE_DIR, 'index.json')
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        index = {}
+    headers = {}
+    if index.get('url') == avatar_url and index.get('etag'):
+        headers['If-None-Match'] = index['etag']
+    response = github_client.get(avatar_url, timeout=10, headers=headers)
+    if response.status_code == 304:
+        return index['image_hash'], None
     if response.status_code != 200:
-        return "Failed to download avatar"
+        print(f"Failed to download avatar, status {response.status_code}", flush=True)
+        return index.get('image_hash'), None
+    image_hash = hashlib.sha256(response.content).hexdigest()
+    os.makedirs(AVATAR_CACHE_DIR, exist_ok=True)
+    write_file_atomic(index_path, json.dumps({'url': avatar_url, 'etag': response.headers.get('ETag'), 'image_hash': image_hash}, indent=4))
+    return image_hash, response.content
+
+
+def rembg_session():
+    """
+    Returns the rembg session, creating it the first time it's needed
+    Importing rembg and loading its model is the slowest part of the whole run, so it's done once and the session is reused
+    """
+    global REMBG_SESSION
+    with REMBG_LOCK:
+        if REMBG_SESSION is None:
+            import rembg
+            REMBG_SESSION = rembg.new_session()
+    return REMBG_SESSION
+
+
+def avatar_cached():
+    """
+    Returns True if the ASCII art of the last downloaded avatar is in the avatar cache
+    """
+    try:
+        with open(os.path.join(AVATAR_CACHE_DIR, 'index.json'), 'r') as f:
+            image_hash = json.load(f).get('image_hash')
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return image_hash is not None and os.path.exists(ascii_cache_path(image_hash))
+
+
+def ascii_cache_path(image_hash):
+    """
+    Returns where the ASCII grid of an image is cached, keyed by the image's sha256 plus the ASCII settings
+    """
+    ascii_key = hashlib.sha256(f'{image_hash} {ASCII_GEN_COLS} {ASCII_WIDTH_RATIO}'.encode('utf-8')).hexdigest()
+    return os.path.join(AVATAR_CACHE_DIR, ascii_key + '.json')
+
+
+def remove_background(content, png_path):
+    """
+    Runs rembg on the avatar image, saves the result as png_path, and returns it as an RGBA array
+    """
+    import numpy as np
+    import rembg
+    from PIL import Image
+    input_array = np.array(Image.open(BytesIO(content)))
+    output_array = rembg.remove(input_array, session=rembg_session())
+    Image.fromarray(output_array).save(png_path)
+    return output_array
+
+
+def render_ascii_grid(rgba, columns=ASCII_GEN_COLS, width_ratio=ASCII_WIDTH_RATIO):
+    """
+    Renders an RGBA image array as colored ASCII art, all in memory
+    Returns {'chars': one string per row, 'colors': one '#rrggbb' per character per row}
+    The image is downsampled to one pixel per character (width_ratio makes up for characters being taller than wide),
+    then luminance picks the character from ASCII_CHARS and the gamma-corrected color is scaled into 55..255 so dark
+    pixels stay visible. This gives the same art as ascii_magic's full-color HTML, without going through HTML
+    """
+    import numpy as np
+    from PIL import Image
+    image = Image.fromarray(np.asarray(rgba, dtype=np.uint8))
+    width, height = image.size
+    scalar = width * width_ratio / columns
+    image = image.resize((int(width * width_ratio / scalar), int(height / scalar)))
+
+    luminance = np.asarray(image.convert('L'), dtype=np.float64) / 255
+    chars = np.array(list(ASCII_CHARS))[(luminance * (len(ASCII_CHARS) - 1)).astype(int)]
 
-    input_image = Image.open(BytesIO(response.content))
-    input_array = np.array(input_image)
-    output_array = rembg.remove(input_array)
-    output_image = Image.fromarray(output_array)
-    output_image.save('avatar.png')
+    rgb = np.asarray(image.convert('RGBA'))[:, :, :3]
+    levels = ((np.arange(256) / 255.0) ** 2.2 * 200 + 55).astype(int)
+    hex_digits = np.array([f'{level:02x}' for level in range(256)])
+    channels = hex_digits[levels[rgb]]
+    colors = np.char.add(np.char.add(np.char.add('#', channels[:, :, 0]), channels[:, :, 1]), channels[:, :, 2])
+    return {'chars': [''.join(row) for row in chars], 'colors': colors.tolist()}
 
-    # Convert to ASCII art
-    art = AsciiArt.from_image("avatar.png")
-    # ascii_text = art.to_ascii(columns=ASCII_GEN_COLS, monochrome=True)  # Adjust columns for size
-    ascii_text = art.to_html(columns=ASCII_GEN_COLS, width_ratio=2, full_color=True)
 
-    with open("ascii.html", "w", encoding="utf-8") as f:
-        f.write("<pre>" + ascii_text + "</pre>")
+def ascii_grid_html(grid):
+    """
+    Returns the grid as colored HTML, in the same markup ascii_magic used for ascii.html
+    """
+    html = ''
+    for chars, colors in zip(grid['chars'], grid['colors']):
+        html += '<span>' + ''.join(f'<span style="color:{color}">{char}</span>' for char, color in zip(chars, colors)) + '</span><br />'
+    return html
 
-    return ascii_text
 
-def svg_overwrite(filename, config, age_data, commit_data, star_data, repo_data, contrib_data, follower_data, loc_data, ascii_text):
+def generate_avatar_ascii(avatar_url):
     """
-    Parse SVG files and update elements with my age, commits, stars, repositories, and lines written
+    Returns the avatar as a character/color grid from render_ascii_grid, and writes it to ascii.html if ASCII_HTML is on
+    Both stages are cached in AVATAR_CACHE_DIR: the background-removed image under the image's sha256, and the grid
+    under the image's sha256 plus the ASCII settings. An unchanged avatar therefore skips rembg and rendering entirely
     """
-    tree = etree.parse(filename)
-    root = tree.getroot()
+    image_hash, content = download_avatar(avatar_url)
+    if image_hash is None:
+        print("Failed to download avatar", flush=True)
+        return None
+
+    ascii_path = ascii_cache_path(image_hash)
+    png_path = os.path.join(AVATAR_CACHE_DIR, image_hash + '.png')
+    if os.path.exists(ascii_path):
+        print("Avatar ASCII art is cached", flush=True)
+        with open(ascii_path, 'r', encoding='utf-8') as f:
+            grid = json.load(f)
+    else:
+        if os.path.exists(png_path):
+            import numpy as np
+            from PIL import Image
+            rgba = np.asarray(Image.open(png_path).convert('RGBA'))
+        else:
+            if content is None: # the avatar is unchanged, but its background-removed image is gone
+                content = github_client.get(avatar_url, timeout=10).content
+            rgba = remove_background(content, png_path)
+        grid = render_ascii_grid(rgba)
+        write_file_atomic(ascii_path, json.dumps(grid))
+        for name in os.listdir(AVATAR_CACHE_DIR): # only keep the current avatar
+            if name not in ('index.json', os.path.basename(ascii_path), os.path.basename(png_path)):
+                os.remove(os.path.join(AVATAR_CACHE_DIR, name))
 
-#     draw_avatar_ascii(root, ascii_text)
-    draw_avatar_color_ascii(root, ascii_text)
-    justify_format(root, 'age_data', age_data, 52)
-    justify_format(root, 'commit_data', commit_data, 22)
-    justify_format(root, 'star_data', star_data, 14)
-    justify_format(root, 'repo_data', repo_data, 7)
-    justify_format(root, 'contrib_data', contrib_data)
-    justify_format(root, 'follower_data', follower_data, 10)
-    justify_format(root, 'loc_data', loc_data[2], 8)
-    justify_format(root, 'loc_add', loc_data[0])
-    justify_format(root, 'loc_del', loc_data[1])
+    if ASCII_HTML:
+        write_file_atomic(os.path.join(OUTPUT_DIR, 'ascii.html'), "<pre>" + ascii_grid_html(grid) + "</pre>")
+    return grid
 
-    for custom in config['custom_values']:
-        justify_format(root, custom['id'], custom['value'], custom['length'])
 
-    tree.write(filename, encoding='utf-8', xml_declaration=True)
+def load_template(filename):
+    """
+    Returns a fresh copy of the parsed template of an output SVG and an index of its elements by id
+    Each template is only parsed once per run, and copied for every render, so nothing drawn into one card (e.g. by batch_card)
+    is left in the next
+    """
+    from lxml import etree
+    path = os.path.join(SVG_TEMPLATE_DIR, filename)
+    if path not in TEMPLATES:
+        TEMPLATES[path] = etree.parse(path)
+    tree = copy.deepcopy(TEMPLATES[path])
+    return tree, {element.get('id'): element for element in tree.xpath('//*[@id]')}
+
 
-def draw_avatar_ascii(root, avatar_text):
+def svg_overwrite(filenames, config, age_data, commit_data, star_data, repo_data, contrib_data, follower_data, loc_data, avatar_grid, contributions_data=None):
+    """
+    Renders the SVG templates into filenames, with my age, commits, stars, repositories, lines written, contributions and avatar
+    The justified values and the avatar are computed once, then applied to every template through its id index
+    The same values always render the same bytes, so an SVG is only rewritten when one of them changed
+    """
+    from lxml import etree
+    values = [('age_data', age_data, 52), ('commit_data', commit_data, 22), ('star_data', star_data, 14), ('repo_data', repo_data, 7),
+              ('contrib_data', contrib_data, 0), ('follower_data', follower_data, 10), ('loc_data', loc_data[2], 8),
+              ('loc_add', loc_data[0], 0), ('loc_del', loc_data[1], 0)]
+    if contributions_data is not None:
+        values.append(('contributions_data', contributions_data, 17))
+    values += [(custom['id'], custom['value'], custom['length']) for custom in config['custom_values']]
+    texts = {}
+    for element_id, new_text, length in values:
+        texts.update(justify_format(element_id, new_text, length))
+    fragment = avatar_fragment(avatar_grid)
+
+    for filename in filenames:
+        tree, index = load_template(filename)
+#         draw_avatar_ascii(index, avatar_text)
+        draw_avatar_color_ascii(index, fragment)
+        for element_id, new_text in texts.items():
+            find_and_replace(index, element_id, new_text)
+        write_file_atomic(os.path.join(OUTPUT_DIR, filename), etree.tostring(tree, encoding='UTF-8', xml_declaration=True))
+
+def draw_avatar_ascii(index, avatar_text):
+    from lxml import etree
     un_pad = int((ASCII_GEN_COLS-ASCII_PRINT_COLS)/2)
     start_x = 15
     start_y = 30
@@ -445,9 +1492,9 @@ def draw_avatar_ascii(root, avatar_text):
     ascii_art_lines = avatar_text.split('\n')
     total_lines = len(ascii_art_lines)
     total_line_offset = 0 if total_lines <= ASCII_MAX_LINES else int((total_lines-ASCII_MAX_LINES) /2)
-    avatar = root.find(f".//*[@id='avatar']")
+    avatar = index['avatar']
     # Clear any existing content
-    for child in avatar:
+    for child in list(avatar):
         avatar.remove(child)
 
     # Add each line of ASCII art as a <tspan>
@@ -462,14 +1509,14 @@ def draw_avatar_ascii(root, avatar_text):
             tspan.text = line[un_pad:-un_pad]
 
 
-def justify_format(root, element_id, new_text, length=0):
+def justify_format(element_id, new_text, length=0):
     """
-    Updates and formats the text of the element, and modifies the amount of dots in the previous element to justify the new text on the svg
+    Formats the text of the element, and the amount of dots in the previous element to justify the new text on the svg
+    Returns {element_id: text, element_id_dots: dots}
     """
     if isinstance(new_text, int):
         new_text = f"{'{:,}'.format(new_text)}"
     new_text = str(new_text)
-    find_and_replace(root, element_id, new_text)
     just_len = max(0, length - len(new_text))
     if length == 0:
         dot_string = ''
@@ -479,69 +1526,97 @@ def justify_format(root, element_id, new_text, length=0):
         dot_string = ' .'
     else:
         dot_string = ' ' + ('.' * just_len) + ' '
-    find_and_replace(root, f"{element_id}_dots", dot_string)
+    return {element_id: new_text, f"{element_id}_dots": dot_string}
 
 
-def find_and_replace(root, element_id, new_text):
+def find_and_replace(index, element_id, new_text):
     """
-    Finds the element in the SVG file and replaces its text with a new value
+    Finds the element in the SVG's id index and replaces its text with a new value
     """
-    element = root.find(f".//*[@id='{element_id}']")
+    element = index.get(element_id)
     if element is not None:
         element.text = new_text
 
 def get_hash_file_name():
+    if SHARED_STORE:
+        return 'shared'
     return hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest()
 
 def commit_counter(comment_size):
     """
-    Counts up my total commits, using the cache file created by cache_builder.
+    Counts up my total commits, using the cache built by cache_builder.
     """
-    total_commits = 0
-    filename = 'cache/'+get_hash_file_name()+'.txt' # Use the same filename as cache_builder
-    with open(filename, 'r') as f:
-        data = f.readlines()
-    cache_comment = data[:comment_size] # save the comment block
-    data = data[comment_size:] # remove those lines
-    for line in data:
-        total_commits += int(line.split()[2])
-    return total_commits
+    data = CACHE if CACHE is not None else load_cache(comment_size)[1]
+    return cache_totals(data)[1]
 
 
-def user_getter(username):
+def profile_getter(username):
     """
-    Returns the account ID and creation time of the user
+    Returns the account ID, creation time, avatar, follower count, repository counts and the stars of the first 100 repositories
+    Everything comes from one query, and the result is cached for the rest of the run. star_counter adds the stars
+    of any further repositories, so that paging doesn't hold up the stages waiting for the profile
     """
-    query_count('user_getter')
+    if username in PROFILE:
+        return PROFILE[username]
+    query_count('profile_getter')
     query = '''
     query($login: String!){
         user(login: $login) {
             id
             createdAt
             avatarUrl
+            followers {
+                totalCount
+            }
+            contributed: repositories(ownerAffiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER]) {
+                totalCount
+            }
+            owned: repositories(first: 100, ownerAffiliations: [OWNER]) {
+                totalCount
+                edges {
+                    node {
+                        ... on Repository {
+                            stargazers {
+                                totalCount
+                            }
+                        }
+                    }
+                }
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+            }
+        }
+        rateLimit {
+            cost
+            remaining
+            resetAt
         }
     }'''
     print(f"Fetching user data for {username}...")
-    variables = {'login': username}
-    request = simple_request(user_getter.__name__, query, variables)
-    print(f"User data fetched, status: {request.status_code}")
-    return {'id': request.json()['data']['user']['id']}, request.json()['data']['user']['createdAt'], request.json()['data']['user']['avatarUrl']
+    request = simple_request(profile_getter.__name__, query, {'login': username}, {'login': username})
+    user = request.json()['data']['user']
+    PROFILE[username] = {
+        'id': user['id'],
+        'created_at': user['createdAt'],
+        'avatar_url': user['avatarUrl'],
+        'follower_data': user['followers']['totalCount'],
+        'repo_data': user['owned']['totalCount'],
+        'contrib_data': user['contributed']['totalCount'],
+        'star_data': stars_counter(user['owned']['edges']),
+        'stars_cursor': user['owned']['pageInfo']['endCursor'] if user['owned']['pageInfo']['hasNextPage'] else None
+    }
+    return PROFILE[username]
+
 
-def follower_getter(username):
+def star_counter(profile):
     """
-    Returns the number of followers of the user
+    Returns the total stars of a profile from profile_getter, paging through the repositories past the first 100 with graph_repos_stars
     """
-    query_count('follower_getter')
-    query = '''
-    query($login: String!){
-        user(login: $login) {
-            followers {
-                totalCount
-            }
-        }
-    }'''
-    request = simple_request(follower_getter.__name__, query, {'login': username})
-    return int(request.json()['data']['user']['followers']['totalCount'])
+    if profile['stars_cursor'] is None:
+        return profile['star_data']
+    return profile['star_data'] + graph_repos_stars('stars', ['OWNER'], profile['stars_cursor'])
 
 
 def query_count(funct_id):
@@ -549,24 +1624,175 @@ def query_count(funct_id):
     Counts how many times the GitHub GraphQL API is called
     """
     global QUERY_COUNT
-    QUERY_COUNT[funct_id] += 1
+    with COUNT_LOCK:
+        QUERY_COUNT[funct_id] += 1
+
+
+def run_stages(stages, processes=None):
+    """
+    Runs a pipeline of stages, each one as soon as the stages it depends on have finished
+    stages maps a name to (funct, dependencies, kind). funct is called with the results of its dependencies, in a thread,
+    or in the processes pool when kind is 'process', for CPU-bound work that threads would run one at a time because of the GIL
+    Every stage is recorded as a telemetry phase. Returns name -> (result, seconds), or raises the first stage's exception,
+    after setting SHUTDOWN so the stages still running stop early
+    """
+    def run_stage(name, funct, args, kind):
+        start = time.perf_counter()
+        with telemetry.span(name):
+            result = processes.submit(funct, *args).result() if kind == 'process' else funct(*args)
+        return result, time.perf_counter() - start
+
+    results, running, waiting = {}, {}, dict(stages)
+    with ThreadPoolExecutor(max_workers=len(stages)) as threads:
+        try:
+            while waiting or running:
+                for name, (funct, dependencies, kind) in list(waiting.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        del waiting[name]
+                        args = [results[dependency][0] for dependency in dependencies]
+                        running[threads.submit(run_stage, name, funct, args, kind)] = name
+                if not running:
+                    raise Exception('Stages wait on stages that never run:', list(waiting))
+                for future in wait(running, return_when=FIRST_COMPLETED).done:
+                    results[running.pop(future)] = future.result()
+        except BaseException:
+            SHUTDOWN.set()
+            if processes:
+                processes.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+
+def prewarm_rembg():
+    """
+    Loads the rembg model in a process pool worker, so it's ready by the time the avatar gets there
+    """
+    rembg_session()
+
+
+def avatar_stage(profile):
+    return generate_avatar_ascii(profile['avatar_url'])
+
 
+def loc_stage(profile):
+    global OWNER_ID
+    OWNER_ID = {'id': profile['id']}
+    return loc_query(['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'], 7)
 
-def perf_counter(funct, *args):
+
+def render_stage(age_data, total_loc, commit_data, star_data, contributions_data, profile, avatar_ascii, config_file='config.json', updated_at=None):
+    """
+    Writes both SVGs and stats.json from the results of the other stages
+    """
+    total_loc = ['{:,}'.format(value) for value in total_loc[:-1]] + total_loc[-1:] # format added, deleted, and total LOC
+    config = load_config(config_file)
+    svg_overwrite(['dark_mode.svg', 'light_mode.svg'], config, age_data, commit_data, star_data, profile['repo_data'],
+                  profile['contrib_data'], profile['follower_data'], total_loc[:-1], avatar_ascii, contributions_data)
+    windows = loc_windows(CACHE) if not USER_NAMES else {} # the shared store has no per-user rollups
+    write_stat_json(total_loc, commit_data, star_data, profile['repo_data'], profile['contrib_data'], profile['follower_data'], contributions_data, updated_at, windows)
+
+
+def render_from_cache():
+    """
+    Rebuilds both SVGs and stats.json without a token or any request to GitHub, e.g. to try out config.json or the templates
+    LOC and commits come from the cache file, the other stats from the last stats.json, and the avatar from its cached ASCII grid.
+    If any of them is missing, raises an Exception naming all of them before anything is written
+    """
+    missing = [filename for filename in (cache_file_name(), os.path.join(OUTPUT_DIR, 'stats.json')) if not os.path.exists(filename)]
+    if not avatar_cached():
+        missing.append('the avatar ASCII art in ' + AVATAR_CACHE_DIR)
+    if missing:
+        raise Exception('RENDER_ONLY renders from the outputs of a full run, which are missing:', ', '.join(missing))
+    with open(os.path.join(OUTPUT_DIR, 'stats.json'), 'r') as f:
+        stats = json.load(f)
+    if 'contributions_data' not in stats:
+        raise Exception('RENDER_ONLY needs contributions_data in stats.json, which is written by a full run')
+    with open(os.path.join(AVATAR_CACHE_DIR, 'index.json'), 'r') as f:
+        with open(ascii_cache_path(json.load(f)['image_hash']), 'r', encoding='utf-8') as grid_file:
+            avatar_ascii = json.load(grid_file)
+    __, data = load_cache(7)
+    __, commit_data, loc_add, loc_del = cache_totals(data)
+    render_stage(daily_readme(BIRTHDAY), [loc_add, loc_del, loc_add - loc_del, stats['total_loc'][-1]], commit_data, stats['star_data'],
+                 stats['contributions_data'], stats, avatar_ascii, updated_at=stats['updated_at']) # the stats themselves weren't updated
+
+
+def batch_main(usernames):
+    """
+    Makes a card for each of usernames in BATCH_DIR/<user>/, fetching each repository's history only once however many of them share it
+    Every user's repositories are listed, then the shared store (cache/shared.*) is brought up to date for all of them at once,
+    with commits and LOC summed per author. Each user's cache file and totals are then derived from the store, so the history
+    requests grow with the number of distinct repositories, not with users x repositories
+    """
+    global USER_NAME, OWNER_ID, SHARED_STORE, AUTHOR_FILTER
+    if LOC_ENGINE == 'git':
+        raise Exception('Batch mode needs LOC_ENGINE=graphql, the git engine only counts the commits of one set of emails')
+    AUTHOR_FILTER = False # the store needs every author's commits
+    profiles, repositories, edges = {}, {}, {}
+    with telemetry.span('repository lists'):
+        for username in usernames:
+            USER_NAME = username
+            profiles[username] = profile_getter(username)
+            repositories[username] = []
+            for page in repository_pages(['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER']):
+                for edge in page['edges']:
+                    repo_hash = hashlib.sha256(edge['node']['nameWithOwner'].encode('utf-8')).hexdigest()
+                    repositories[username].append(repo_hash)
+                    edges[repo_hash] = edge
+    print(f"{len(usernames)} users share {len(edges)} repositories", flush=True)
+
+    SHARED_STORE, OWNER_ID = True, None
+    try:
+        with telemetry.span('shared store'):
+            cache_builder(edges.values(), 0, False)
+        store = CACHE
+    finally:
+        SHARED_STORE = False
+    for username in usernames:
+        with telemetry.span('card', user=username):
+            batch_card(username, profiles[username], {repo_hash: store[repo_hash] for repo_hash in repositories[username]})
+
+
+def batch_card(username, profile, rows):
     """
-    Calculates the time it takes for a function to run
-    Returns the function result and the time differential
+    Writes username's cache file from their repositories' rows of the shared store, and renders their card into BATCH_DIR/<user>/
+    Their config.json there is used if they have one, and its "birthday" (YYYY-MM-DD) for the age, which is otherwise the account's age
     """
-    start = time.perf_counter()
-    funct_return = funct(*args)
-    return funct_return, time.perf_counter() - start
+    global USER_NAME, OWNER_ID, OUTPUT_DIR, AVATAR_CACHE_DIR
+    USER_NAME, OWNER_ID = username, {'id': profile['id']}
+    OUTPUT_DIR = os.path.join(BATCH_DIR, username)
+    AVATAR_CACHE_DIR = os.path.join('cache', 'avatars', username)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    cache_comment, data = load_cache(7)
+    CHECKPOINTS.clear() # the user's own histories aren't paged, the store's are
+    data.clear()
+    for repo_hash, row in rows.items():
+        sums = AUTHORS.get(repo_hash, {}).get(profile['id'], [0, 0, 0]) if row[0] else [0, 0, 0]
+        data[repo_hash] = [row[0], sums[0], sums[1], sums[2], row[4], None]
+    write_cache(data, cache_comment)
+    __, commit_data, loc_add, loc_del = cache_totals(data)
+
+    config_file = os.path.join(OUTPUT_DIR, 'config.json')
+    if not os.path.exists(config_file):
+        config_file = 'config.json'
+    with open(config_file, 'r') as f:
+        birthday = json.load(f).get('birthday') or profile['created_at'][:10]
+    age_data = daily_readme(datetime.datetime.fromisoformat(birthday))
+    avatar_ascii = generate_avatar_ascii(profile['avatar_url'])
+    render_stage(age_data, [loc_add, loc_del, loc_add - loc_del, True], commit_data, star_counter(profile),
+                 contribution_counter(profile), profile, avatar_ascii, config_file)
+    print(f"Wrote the card of {username} to {OUTPUT_DIR}", flush=True)
+
 
 def pretty_now_time():
     eastern = pytz.timezone('US/Eastern')
     current_time = datetime.datetime.now(eastern)
     return current_time.strftime('%B %d, %Y %I:%M %p %Z')
 
-def write_stat_json(total_loc,commit_data,star_data,repo_data,contrib_data,follower_data):
+def write_stat_json(total_loc,commit_data,star_data,repo_data,contrib_data,follower_data,contributions_data,updated_at=None,windows=None):
+    """
+    Writes stats.json, unless the stats are the same as in the one on disk: updated_at only moves when a stat actually changed
+    The cached flag at the end of total_loc isn't a stat, it only tells whether any repository had to be counted this run
+    """
     data = {
         "total_loc":total_loc,
         "commit_data":commit_data,
@@ -574,11 +1800,22 @@ def write_stat_json(total_loc,commit_data,star_data,repo_data,contrib_data,follo
         "repo_data":repo_data,
         "contrib_data":contrib_data,
         "follower_data":follower_data,
-        "updated_at": pretty_now_time()
+        "contributions_data":contributions_data,
+        "updated_at": None
     }
-
-    with open("stats.json", "w") as file:
-        json.dump(data, file, indent=4)
+    data.update(windows or {}) # loc_this_year, commits_this_year, ... see loc_windows
+    filename = os.path.join(OUTPUT_DIR, "stats.json")
+    try:
+        with open(filename, 'r') as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = None
+    stats = lambda values: {**values, 'total_loc': values.get('total_loc', [])[:-1], 'updated_at': None}
+    if previous is not None and stats(previous) == stats(data):
+        print("Stats are unchanged, keeping stats.json", flush=True)
+        return
+    data['updated_at'] = updated_at or pretty_now_time()
+    write_file_atomic(filename, json.dumps(data, indent=4))
 
 def formatter(query_type, difference, funct_return=False, whitespace=0):
     """
@@ -593,33 +1830,53 @@ def formatter(query_type, difference, funct_return=False, whitespace=0):
 
 
 if __name__ == '__main__':
-    print('Calculation times:')
-    # define global variable for owner ID and calculate user's creation date
-    user_data, user_time = perf_counter(user_getter, USER_NAME)
-    OWNER_ID, acc_date, avatar_url = user_data
-    formatter('account data', user_time)
-    age_data, age_time = perf_counter(daily_readme, datetime.datetime(1991, 11, 20))
-    formatter('age calculation', age_time)
-    total_loc, loc_time = perf_counter(loc_query, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'], 7)
-    formatter('LOC (cached)', loc_time) if total_loc[-1] else formatter('LOC (no cache)', loc_time)
-    commit_data, commit_time = perf_counter(commit_counter, 7)
-    star_data, star_time = perf_counter(graph_repos_stars, 'stars', ['OWNER'])
-    repo_data, repo_time = perf_counter(graph_repos_stars, 'repos', ['OWNER'])
-    contrib_data, contrib_time = perf_counter(graph_repos_stars, 'repos', ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'])
-    follower_data, follower_time = perf_counter(follower_getter, USER_NAME)
-    avatar_ascii, ascii_time = perf_counter(generate_avatar_ascii, avatar_url)
-
-    for index in range(len(total_loc)-1): total_loc[index] = '{:,}'.format(total_loc[index]) # format added, deleted, and total LOC
-
-    config = load_config('config.json')
-    svg_overwrite('dark_mode.svg', config, age_data, commit_data, star_data, repo_data, contrib_data, follower_data, total_loc[:-1], avatar_ascii)
-    svg_overwrite('light_mode.svg', config, age_data, commit_data, star_data, repo_data, contrib_data, follower_data, total_loc[:-1], avatar_ascii)
-    write_stat_json(total_loc,commit_data,star_data ,repo_data ,contrib_data ,follower_data)
-
-    # move cursor to override 'Calculation times:' with 'Total function time:' and the total function time, then move cursor back
-    print('\033[F\033[F\033[F\033[F\033[F\033[F\033[F\033[F',
-        '{:<21}'.format('Total function time:'), '{:>11}'.format('%.4f' % (user_time + age_time + loc_time + commit_time + star_time + repo_time + contrib_time)),
-        ' s \033[E\033[E\033[E\033[E\033[E\033[E\033[E\033[E', sep='')
+    # turn SIGTERM (e.g. the workflow timing out) into an exception, so the cache and checkpoints are saved on the way out.
+    # Only the main thread gets signals, so SHUTDOWN tells the stage threads
+    signal.signal(signal.SIGTERM, lambda signum, frame: (SHUTDOWN.set(), sys.exit('Terminated')))
+    if RENDER_ONLY:
+        with telemetry.span('render only'):
+            render_from_cache()
+    elif USER_NAMES:
+        batch_main(USER_NAMES)
+    else:
+        # The stages run concurrently once the profile is in: LOC and commit count, the stars past the first 100 repositories,
+        # the contributions and the avatar. Rendering waits for all of them. An uncached avatar goes through rembg in its own process, which starts
+        # loading the model right away, while the GitHub requests are running
+        avatar_kind, processes = 'thread', None
+        if not avatar_cached():
+            avatar_kind, processes = 'process', ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            processes.submit(prewarm_rembg)
+        stages = {
+            'account data': (functools.partial(profile_getter, USER_NAME), [], 'thread'),
+            'age calculation': (functools.partial(daily_readme, BIRTHDAY), [], 'thread'),
+            'LOC': (loc_stage, ['account data'], 'thread'),
+            'commit count': (lambda total_loc: commit_counter(7), ['LOC'], 'thread'),
+            'stars': (star_counter, ['account data'], 'thread'),
+            'contributions': (contribution_counter, ['account data'], 'thread'),
+            'avatar': (avatar_stage, ['account data'], avatar_kind),
+            'SVG rendering': (render_stage, ['age calculation', 'LOC', 'commit count', 'stars', 'contributions', 'account data', 'avatar'], 'thread'),
+        }
+        try:
+            results = run_stages(stages, processes)
+        finally:
+            if processes:
+                processes.shutdown()
+        telemetry.record('startup', 'phase', START_TIME, github_client.FIRST_REQUEST_TIME - START_TIME)
+
+        print('Calculation times:')
+        formatter('startup', github_client.FIRST_REQUEST_TIME - START_TIME)
+        for name in stages:
+            result, seconds = results[name]
+            if name == 'LOC':
+                name = 'LOC (cached)' if result[-1] else 'LOC (no cache)'
+            formatter(name, seconds)
+
+    # wall time since the process started, so every stage and everything between them is included
+    telemetry.record('total', 'phase', START_TIME, time.perf_counter() - START_TIME)
+    formatter('Total time', time.perf_counter() - START_TIME)
+    telemetry.write_trace(TRACE_FILE)
+    if TRACE_CHROME:
+        telemetry.write_chrome_trace(os.path.splitext(TRACE_FILE)[0] + '.chrome.json')
 
     print('Total GitHub GraphQL API calls:', '{:>3}'.format(sum(QUERY_COUNT.values())))
     for funct_name, count in QUERY_COUNT.items(): print('{:<28}'.format('   ' + funct_name + ':'), '{:>6}'.format(count))
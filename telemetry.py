@@ -0,0 +1,90 @@
+import contextlib
+import json
+import threading
+import time
+
+# Spans for every phase of index.py and every request to GitHub, written as a JSON trace next to stats.json
+# A span is {'name', 'category', 'start', 'duration', 'thread', 'attributes'}, with times in seconds since ORIGIN.
+# write_chrome_trace exports the same spans in the Chrome trace event format, for chrome://tracing, Perfetto or speedscope.
+ORIGIN = time.perf_counter()  # index.py moves this back to when it started
+SPANS = []
+SPAN_LOCK = threading.Lock()
+
+
+def record(name, category, start, duration, **attributes):
+    """
+    Records a finished span that started at time.perf_counter() start and took duration seconds
+    """
+    span = {'name': name, 'category': category, 'start': start - ORIGIN, 'duration': duration,
+            'thread': threading.current_thread().name, 'attributes': attributes}
+    with SPAN_LOCK:
+        SPANS.append(span)
+    return span
+
+
+@contextlib.contextmanager
+def span(name, category='phase', **attributes):
+    """
+    Records a span around the with block. The block can add attributes to the dict it gets
+    """
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record(name, category, start, time.perf_counter() - start, **attributes)
+
+
+def summary():
+    """
+    Returns the time spent per phase, the request totals, and the repositories that took the most request time
+    A batched request's time is split evenly between the repositories it fetched
+    """
+    with SPAN_LOCK:
+        spans = list(SPANS)
+    requests = [span for span in spans if span['category'] == 'request']
+    repositories = {}
+    for request in requests:
+        names = request['attributes'].get('repositories') or []
+        for name in names:
+            repository = repositories.setdefault(name, {'repository': name, 'request_time': 0.0, 'requests': 0, 'bytes': 0})
+            repository['request_time'] += request['duration'] / len(names)
+            repository['requests'] += 1
+            repository['bytes'] += request['attributes'].get('bytes', 0) // len(names)
+    return {
+        'phases': {span['name']: round(span['duration'], 4) for span in spans if span['category'] == 'phase'},
+        'requests': len(requests),
+        'request_time': round(sum(request['duration'] for request in requests), 4),
+        'retries': sum(request['attributes'].get('retries', 0) for request in requests),
+        'bytes': sum(request['attributes'].get('bytes', 0) for request in requests),
+        'cost': sum(request['attributes'].get('cost') or 0 for request in requests),
+        'slowest_repositories': [{**repository, 'request_time': round(repository['request_time'], 4)}
+                                 for repository in sorted(repositories.values(), key=lambda repository: -repository['request_time'])[:10]],
+    }
+
+
+def write_trace(filename):
+    """
+    Writes the spans and their summary as JSON
+    """
+    with SPAN_LOCK:
+        spans = sorted(SPANS, key=lambda span: span['start'])
+    with open(filename, 'w') as f:
+        json.dump({'summary': summary(), 'spans': spans}, f, indent=4)
+
+
+def write_chrome_trace(filename):
+    """
+    Writes the spans in the Chrome trace event format, one track per thread
+    """
+    with SPAN_LOCK:
+        spans = sorted(SPANS, key=lambda span: span['start'])
+    threads = {}
+    events = []
+    for span in spans:
+        tid = threads.setdefault(span['thread'], len(threads))
+        events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                       'ts': round(span['start'] * 1e6), 'dur': round(span['duration'] * 1e6), 'args': span['attributes']})
+    for thread, tid in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)